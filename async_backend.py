@@ -0,0 +1,286 @@
+"""ASGI version of the chat server.
+
+Same routes as backend.py, but LLM calls use ainvoke/astream and graph
+queries go through the async neo4j driver, so one process can hold many
+open conversations. Run with:
+
+    hypercorn async_backend:app --bind 0.0.0.0:8000
+"""
+import os
+import time
+import asyncio
+from dotenv import load_dotenv
+
+from quart import Quart, Response, request, jsonify
+from quart_cors import cors
+
+from base_logger import logger
+
+from chains import warm_up_models
+from graph import close_async_driver, aget_graph_version
+from retrieval import aget_theorems_subgraph, theorem_cache
+from router import aget_router, route_question, resolve_theorem_names, use_question_router
+from embeddings import get_embedding_model, asimilar_theorem_names
+from history import conversation_history
+from pipeline import (llm_name, ollama_base_url, answer_cache, parse_chain, answer_chain, wants_vector_retrieval,
+                      without_rag, answer_inputs, answer_cache_key, generation_key, finish_answer, sse_event)
+from coalesce import AsyncSingleFlight
+from health import AsyncHealthChecker, acheck_neo4j, check_ollama
+from metrics import (registry, cache_metrics, flight_metrics, CONTENT_TYPE, request_seconds, requests_total,
+                     requests_in_progress, stage_seconds, time_to_first_token)
+
+load_dotenv(".env")
+
+max_concurrent_generations = int(os.getenv("MAX_CONCURRENT_GENERATIONS", "4"))
+
+app = cors(Quart(__name__), allow_origin="*", allow_methods=["GET", "POST", "OPTIONS"], allow_headers=["Content-Type"])
+
+# Requests past the cap wait here instead of piling onto the Ollama box
+generation_slots = asyncio.Semaphore(max_concurrent_generations)
+# Identical questions asked at the same time share one generation
+in_flight = AsyncSingleFlight()
+health_checker = AsyncHealthChecker({
+    "neo4j": acheck_neo4j,
+    "ollama": lambda: check_ollama(ollama_base_url)
+})
+started_at = time.monotonic()
+registry.collector("chat", lambda: cache_metrics({"theorem": theorem_cache, "answer": answer_cache}) + flight_metrics(in_flight))
+
+
+async def aprepare_respond(question: str, chat_history= ""):
+    """Async prepare_respond: returns (template_name, inputs, theorems)."""
+    query = None
+    router = None
+    with stage_seconds.time(stage="route"):
+        try:
+            router = await aget_router()
+        except Exception as e:
+            logger.info(f"Question router unavailable: {e}")
+        if use_question_router:
+            query = route_question(router, question, chat_history)
+
+    if query is None:
+        with stage_seconds.time(stage="parse_question"):
+            query = await parse_chain().ainvoke({"chat_history": chat_history, "question": question})
+        logger.info(query)
+
+    theorems = []
+    if wants_vector_retrieval(query):
+        try:
+            with stage_seconds.time(stage="vector_retrieval"):
+                theorems = await aget_theorems_subgraph(await asimilar_theorem_names(question))
+        except Exception as e:
+            logger.info(f"Vector retrieval failed: {e}")
+    if without_rag(query, theorems):
+        return answer_inputs("answer_without_rag", theorems, question, chat_history)
+
+    if not theorems:
+        with stage_seconds.time(stage="retrieval"):
+            theorems = await aget_theorems_subgraph(resolve_theorem_names(router, query))
+    return answer_inputs("answer_with_rag", theorems, question, chat_history)
+
+async def alookup_answer(question: str, chat_history= ""):
+    """Async backend.lookup_answer: returns (key, embedding, version, cached)."""
+    key = answer_cache_key(question, chat_history)
+    if key is None:
+        return None, None, None, None
+    if answer_cache.version_due():
+        # Without the graph version a cached answer could be stale, the cache is skipped (not the question)
+        try:
+            answer_cache.set_version(await aget_graph_version())
+        except Exception as e:
+            logger.info(f"Graph version unavailable, answer cache skipped: {e}")
+            return None, None, None, None
+    version = answer_cache.version
+    found, cached = answer_cache.lookup(key)
+    embedding = None
+    if not found and answer_cache.threshold:
+        try:
+            embedding = await get_embedding_model().aembed_query(question)
+        except Exception as e:
+            logger.info(f"Failed to embed question for the answer cache: {e}")
+        found, cached = await asyncio.to_thread(answer_cache.lookup_similar, embedding)
+    if found:
+        logger.info("answer cache hit")
+    return key, embedding, version, cached if found else None
+
+async def aproduce_answer(flight, question: str, chat_history: str, key, embedding, version):
+    """Async backend.produce_answer, run as its own task and holding a generation slot."""
+    with stage_seconds.time(stage="queue"):
+        await generation_slots.acquire()
+    try:
+        template_name, inputs, theorems = await aprepare_respond(question, chat_history)
+        flight.publish("sources", theorems)
+        tokens = []
+        with stage_seconds.time(stage="generate"):
+            async for token in answer_chain(template_name).astream(inputs):
+                if token:
+                    tokens.append(token)
+                    flight.publish("token", token)
+    finally:
+        generation_slots.release()
+    finish_answer(template_name, tokens, theorems, key, embedding, version)
+
+def ajoin_generation(question: str, chat_history: str, key, embedding, version):
+    # Followers don't take a generation slot, only the producer task does
+    flight_key = generation_key(question, chat_history)
+    flight, leader = in_flight.join(flight_key, lambda flight: aproduce_answer(flight, question, chat_history, key, embedding, version))
+    if not leader:
+        logger.info("joined in-flight generation")
+    return flight_key, flight
+
+async def agenerate_respond(question: str, conversation_id= None):
+    started = time.perf_counter()
+    # History store calls can hit SQLite or the summary LLM, they run off the event loop
+    with stage_seconds.time(stage="history"):
+        chat_history = await asyncio.to_thread(conversation_history.render, conversation_id) if conversation_id else ""
+    with stage_seconds.time(stage="cache_lookup"):
+        key, embedding, version, cached = await alookup_answer(question, chat_history)
+    if cached:
+        answer, theorems = cached[0], cached[1]
+    else:
+        flight_key, flight = ajoin_generation(question, chat_history, key, embedding, version)
+        try:
+            answer, theorems = await flight.result()
+        finally:
+            in_flight.leave(flight_key, flight)
+    # /chat sends the whole answer at once, its first token arrives with the last
+    time_to_first_token.observe(time.perf_counter() - started, endpoint="chat")
+    if conversation_id:
+        with stage_seconds.time(stage="history"):
+            await asyncio.to_thread(conversation_history.append, conversation_id, question, answer)
+    return answer, theorems
+
+async def astream_respond(question: str, conversation_id= None):
+    started = time.perf_counter()
+    with stage_seconds.time(stage="history"):
+        chat_history = await asyncio.to_thread(conversation_history.render, conversation_id) if conversation_id else ""
+    with stage_seconds.time(stage="cache_lookup"):
+        key, embedding, version, cached = await alookup_answer(question, chat_history)
+    if cached:
+        yield "sources", cached[1]
+        time_to_first_token.observe(time.perf_counter() - started, endpoint="chat_stream")
+        yield "token", cached[0]
+        if conversation_id:
+            await asyncio.to_thread(conversation_history.append, conversation_id, question, cached[0])
+        return
+
+    flight_key, flight = ajoin_generation(question, chat_history, key, embedding, version)
+    tokens = []
+    # A client that disconnects (CancelledError/GeneratorExit) only stops following the flight
+    events = flight.follow()
+    try:
+        async for event, payload in events:
+            if event == "token":
+                if not tokens:
+                    time_to_first_token.observe(time.perf_counter() - started, endpoint="chat_stream")
+                tokens.append(payload)
+            yield event, payload
+    finally:
+        in_flight.leave(flight_key, flight)
+        await events.aclose()
+    if conversation_id:
+        with stage_seconds.time(stage="history"):
+            await asyncio.to_thread(conversation_history.append, conversation_id, question, "".join(tokens))
+
+
+@app.route('/health', methods=['GET'])
+async def health_check():
+    """Liveness: the process is up and serving, dependencies aren't probed"""
+    return jsonify({
+        "status": "alive",
+        "llm": llm_name,
+        "database": "neo4j",
+        "uptime_seconds": round(time.monotonic() - started_at, 1)
+    })
+
+@app.route('/ready', methods=['GET'])
+async def readiness_check():
+    """Readiness: neo4j answers and the models are available in Ollama, 503 otherwise"""
+    report = await health_checker.acheck()
+    return jsonify(report), 200 if report["status"] == "ready" else 503
+
+@app.route('/stats', methods=['GET'])
+async def cache_stats():
+    """Hit/miss counters of the in-process caches, for sizing them"""
+    return jsonify({
+        "theorem_cache": theorem_cache.stats(),
+        "answer_cache": answer_cache.stats(),
+        "in_flight": in_flight.stats()
+    })
+
+@app.route('/metrics', methods=['GET'])
+async def prometheus_metrics():
+    """Per-stage latency, time to first token, token counts, cache hit rates, in Prometheus text format"""
+    return Response(registry.render(), content_type=CONTENT_TYPE)
+
+@app.route('/chat', methods=['POST'])
+async def chat():
+    with requests_in_progress.track(endpoint="chat"), request_seconds.time(endpoint="chat"):
+        response = await answer_chat()
+    requests_total.inc(endpoint="chat", status=str(response[1]) if isinstance(response, tuple) else "200")
+    return response
+
+async def answer_chat():
+    try:
+        data = await request.get_json()
+
+        if not data or 'message' not in data:
+            logger.info("No message provided")
+            return jsonify({"error": "No message provided"}), 400
+
+        message = data['message']
+        conversation_id = data.get('conversation_id')
+        logger.info(f"Received message: {message}")
+
+        answer, theorem = await agenerate_respond(message, conversation_id)
+        return jsonify({
+            "response": answer,
+            "sources": theorem
+        })
+
+    except Exception as e:
+        logger.info(f"ERROR: {str(e)}")
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/chat/stream', methods=['POST'])
+async def chat_stream():
+    """Same as /chat, answered as Server-Sent Events: sources, token..., done (or error)."""
+    data = await request.get_json(silent=True)
+
+    if not data or 'message' not in data:
+        logger.info("No message provided")
+        return jsonify({"error": "No message provided"}), 400
+
+    message = data['message']
+    conversation_id = data.get('conversation_id')
+    logger.info(f"Received message (stream): {message}")
+
+    async def events():
+        status = "200"
+        with requests_in_progress.track(endpoint="chat_stream"), request_seconds.time(endpoint="chat_stream"):
+            try:
+                async for event, payload in astream_respond(message, conversation_id):
+                    yield sse_event(event, payload)
+                yield sse_event("done", {})
+            except Exception as e:
+                status = "500"
+                logger.info(f"ERROR: {str(e)}")
+                yield sse_event("error", {"error": str(e)})
+        requests_total.inc(endpoint="chat_stream", status=status)
+
+    response = Response(events(), mimetype="text/event-stream", headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+    response.timeout = None
+    return response
+
+@app.before_serving
+async def startup():
+    if os.getenv("OLLAMA_WARM_UP", "1") == "1":
+        await asyncio.to_thread(warm_up_models, [llm_name], ollama_base_url)
+
+@app.after_serving
+async def shutdown():
+    await close_async_driver()
+
+if __name__ == "__main__":
+    app.run(host='0.0.0.0', port=8000)
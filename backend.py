@@ -1,30 +1,40 @@
 import os
+import time
 from dotenv import load_dotenv
-from typing import List, Dict, Any
-import json
+from typing import List, Dict, Any, Optional
 from pydantic import BaseModel
 
-from langchain_neo4j import Neo4jGraph
-from langchain_ollama.llms import OllamaLLM
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify, stream_with_context
 from flask_cors import CORS
-import ollama
 
 
-from templates import templates
-from theorem import Theorem
 from base_logger import logger
 
-from chains import create_llm_chain
+from chains import warm_up_models
+from graph import get_graph_version
+from retrieval import get_theorems_subgraph, theorem_cache
+from router import get_router, route_question, resolve_theorem_names, use_question_router
+from embeddings import get_embedding_model, similar_theorem_names
+from history import conversation_history
+from pipeline import (llm_name, ollama_base_url, answer_cache, parse_chain, answer_chain, wants_vector_retrieval,
+                      without_rag, answer_inputs, answer_cache_key, generation_key, finish_answer, sse_event)
+from coalesce import SingleFlight
+from health import HealthChecker, check_neo4j, check_ollama
+from metrics import (registry, cache_metrics, flight_metrics, CONTENT_TYPE, request_seconds, requests_total,
+                     requests_in_progress, stage_seconds, time_to_first_token)
 
 load_dotenv(".env")
 
-neo4j_url = os.getenv("NEO4J_URI")
-neo4j_username = os.getenv("NEO4J_USERNAME")
-neo4j_password = os.getenv("NEO4J_PASSWORD")
 github_url = os.getenv("Github_URL")
-ollama_base_url = os.getenv("OLLAMA_BASE_URL")
-llm_name = os.getenv("CHAT_LLM")
+
+# Identical questions asked at the same time share one generation
+in_flight = SingleFlight()
+health_checker = HealthChecker({
+    "neo4j": check_neo4j,
+    "ollama": lambda: check_ollama(ollama_base_url)
+})
+started_at = time.monotonic()
+registry.collector("chat", lambda: cache_metrics({"theorem": theorem_cache, "answer": answer_cache}) + flight_metrics(in_flight))
 
 app = Flask(__name__)
 
@@ -37,96 +47,203 @@ CORS(app, resources={
 })
 
 
-try:
-    neo4j_graph = Neo4jGraph(
-        url=neo4j_url, username=neo4j_username, password=neo4j_password, refresh_schema=False
-    )
-    logger.info("Connected to neo4j.")
-except Exception as e:
-    logger.info(f"Error in connecting to neo4j: {e}")
-
-
-chat_history = " "
 class ChatRequest(BaseModel):
     message: str
-    conversation_id: str = "default"
+    conversation_id: Optional[str] = None
 
 class ChatResponse(BaseModel):
     response: str
     sources: List[Dict] = []
 
-def get_dependencies(theorem_name: str) -> List[str]:
-        query = """
-        MATCH (t:Theorem {name: $name})-[:DEPENDS_ON]->(dep:Theorem)
-        RETURN dep.name as dependency
-        ORDER BY dep.name
-        """
-        result = neo4j_graph.query(query, params={'name': theorem_name.strip()})
-        return [record['dependency'] for record in result]
-
-def get_theorem_by_name(theorem_name: str):
-    query = """
-    MATCH (t:Theorem {name: $name})
-    RETURN t.name as name,
-        t.statement as statement,
-        t.proof as proof,
-        t.type as type
-    """
-    
-    result = neo4j_graph.query(query, params={'name': theorem_name.strip()})
 #add here some more get and move them
-def generate_respond(question:str, chat_history= chat_history, use_chat_history = True):
-    answer = ""
-    source = []
-
-    llm = create_llm_chain(
-        llm_name= llm_name,
-        ollama_base_url= ollama_base_url,
-        template= templates["parse_question"]
-    )
+def prepare_respond(question:str, chat_history= ""):
+    """Parse the question and fetch the theorems it needs.
+
+    Returns the answer template to use, its inputs and the theorems found,
+    so the answer itself can be generated in one go or streamed.
+    """
+    query = None
+    router = None
+    with stage_seconds.time(stage="route"):
+        try:
+            router = get_router()
+        except Exception as e:
+            logger.info(f"Question router unavailable: {e}")
+        if use_question_router:
+            query = route_question(router, question, chat_history)
+
+    if query is None:
+        with stage_seconds.time(stage="parse_question"):
+            query = parse_chain().invoke({"chat_history": chat_history, "question": question})
+        logger.info(query)
+
+    theorems = []
+    if wants_vector_retrieval(query):
+        try:
+            with stage_seconds.time(stage="vector_retrieval"):
+                theorems = get_theorems_subgraph(similar_theorem_names(question))
+        except Exception as e:
+            logger.info(f"Vector retrieval failed: {e}")
+    if without_rag(query, theorems):
+        return answer_inputs("answer_without_rag", theorems, question, chat_history)
+
+    if not theorems:
+        with stage_seconds.time(stage="retrieval"):
+            theorems = get_theorems_subgraph(resolve_theorem_names(router, query))
+    return answer_inputs("answer_with_rag", theorems, question, chat_history)
+
+def lookup_answer(question:str, chat_history= ""):
+    """Look the question up in answer_cache.
+
+    Returns (key, embedding, version, cached) where cached is (answer, sources, embedding)
+    or None; key is None when the question can't be cached at all.
+    """
+    key = answer_cache_key(question, chat_history)
+    if key is None:
+        return None, None, None, None
+    if answer_cache.version_due():
+        # Without the graph version a cached answer could be stale, the cache is skipped (not the question)
+        try:
+            answer_cache.set_version(get_graph_version())
+        except Exception as e:
+            logger.info(f"Graph version unavailable, answer cache skipped: {e}")
+            return None, None, None, None
+    version = answer_cache.version
+    found, cached = answer_cache.lookup(key)
+    embedding = None
+    if not found and answer_cache.threshold:
+        try:
+            embedding = get_embedding_model().embed_query(question)
+        except Exception as e:
+            logger.info(f"Failed to embed question for the answer cache: {e}")
+        found, cached = answer_cache.lookup_similar(embedding)
+    if found:
+        logger.info("answer cache hit")
+    return key, embedding, version, cached if found else None
+
+def produce_answer(flight, question: str, chat_history: str, key, embedding, version):
+    """Generate the answer into flight: ("sources", theorems), then ("token", text) as they stream.
 
-    query = llm.invoke({"chat_history": chat_history, "question": question})
-    logger.info(query)
+    Runs on its own thread, not in a request, so the answer is finished and
+    cached for everyone following it whichever client disconnects.
+    """
+    template_name, inputs, theorems = prepare_respond(question, chat_history)
+    flight.publish("sources", theorems)
+    tokens = []
+    stream = answer_chain(template_name).stream(inputs)
+    try:
+        with stage_seconds.time(stage="generate"):
+            for token in stream:
+                if flight.cancelled:
+                    return
+                if token:
+                    tokens.append(token)
+                    flight.publish("token", token)
+    finally:
+        # Closing the stream ends the request to Ollama when the generation is cancelled
+        stream.close()
+    finish_answer(template_name, tokens, theorems, key, embedding, version)
 
-    theorems = {}
-    if query.strip() in ["No algebra", "whatever"]:
-        llm = create_llm_chain(
-            llm_name= llm_name,
-            ollama_base_url= ollama_base_url,
-            template= templates["answer_without_rag"]
-        )
-        logger.info("used answer_without_rag")
+def join_generation(question: str, chat_history: str, key, embedding, version):
+    flight_key = generation_key(question, chat_history)
+    flight, leader = in_flight.join(flight_key, lambda flight: produce_answer(flight, question, chat_history, key, embedding, version))
+    if not leader:
+        logger.info("joined in-flight generation")
+    return flight_key, flight
 
-        answer = llm.invoke({"chat_history": chat_history, "question": question})
+def generate_respond(question:str, conversation_id= None):
+    started = time.perf_counter()
+    # Without a conversation_id there is no history, clients must not share one
+    with stage_seconds.time(stage="history"):
+        chat_history = conversation_history.render(conversation_id) if conversation_id else ""
+    with stage_seconds.time(stage="cache_lookup"):
+        key, embedding, version, cached = lookup_answer(question, chat_history)
+    if cached:
+        answer, theorems = cached[0], cached[1]
     else:
-        theorems_name = query.split(';')
-        for t_name in theorems_name:
-            theorems[get_theorem_by_name(t_name)] = [get_theorem_by_name(dep) for dep in get_dependencies(t_name)]
-        llm = create_llm_chain(
-            llm_name= llm_name,
-            ollama_base_url= ollama_base_url,
-            template= templates["answer_with_rag"]
-        )
-        logger.info("used answer_with_rag")
-
-        answer = llm.invoke({"chat_history": chat_history, "question": question, "theorems": theorems})
-    if use_chat_history:
-        chat_history += question + "\n" + answer + "\n"
+        flight_key, flight = join_generation(question, chat_history, key, embedding, version)
+        try:
+            answer, theorems = flight.result()
+        finally:
+            in_flight.leave(flight_key, flight)
+    # /chat sends the whole answer at once, its first token arrives with the last
+    time_to_first_token.observe(time.perf_counter() - started, endpoint="chat")
+    if conversation_id:
+        with stage_seconds.time(stage="history"):
+            conversation_history.append(conversation_id, question, answer)
     return answer, theorems
-    
 
+def stream_respond(question:str, conversation_id= None):
+    """Same as generate_respond but yields ("sources", theorems) then ("token", text) events."""
+    started = time.perf_counter()
+    with stage_seconds.time(stage="history"):
+        chat_history = conversation_history.render(conversation_id) if conversation_id else ""
+    with stage_seconds.time(stage="cache_lookup"):
+        key, embedding, version, cached = lookup_answer(question, chat_history)
+    if cached:
+        yield "sources", cached[1]
+        time_to_first_token.observe(time.perf_counter() - started, endpoint="chat_stream")
+        yield "token", cached[0]
+        if conversation_id:
+            conversation_history.append(conversation_id, question, cached[0])
+        return
+
+    flight_key, flight = join_generation(question, chat_history, key, embedding, version)
+    tokens = []
+    # A client that disconnects mid-stream (GeneratorExit) only stops following the flight
+    events = flight.follow()
+    try:
+        for event, payload in events:
+            if event == "token":
+                if not tokens:
+                    time_to_first_token.observe(time.perf_counter() - started, endpoint="chat_stream")
+                tokens.append(payload)
+            yield event, payload
+    finally:
+        events.close()
+        in_flight.leave(flight_key, flight)
+    if conversation_id:
+        with stage_seconds.time(stage="history"):
+            conversation_history.append(conversation_id, question, "".join(tokens))
 
 @app.route('/health', methods=['GET'])
 def health_check():
-    """Health check endpoint"""
+    """Liveness: the process is up and serving, dependencies aren't probed"""
+    return jsonify({
+        "status": "alive",
+        "llm": llm_name,
+        "database": "neo4j",
+        "uptime_seconds": round(time.monotonic() - started_at, 1)
+    })
+
+@app.route('/ready', methods=['GET'])
+def readiness_check():
+    """Readiness: neo4j answers and the models are available in Ollama, 503 otherwise"""
+    report = health_checker.check()
+    return jsonify(report), 200 if report["status"] == "ready" else 503
+
+@app.route('/stats', methods=['GET'])
+def cache_stats():
+    """Hit/miss counters of the in-process caches, for sizing them"""
     return jsonify({
-        "status": "healthy",
-        "llm": "qwen2-math:7b",
-        "database": "neo4j"
+        "theorem_cache": theorem_cache.stats(),
+        "answer_cache": answer_cache.stats(),
+        "in_flight": in_flight.stats()
     })
 
+@app.route('/metrics', methods=['GET'])
+def prometheus_metrics():
+    """Per-stage latency, time to first token, token counts, cache hit rates, in Prometheus text format"""
+    return Response(registry.render(), content_type=CONTENT_TYPE)
+
 @app.route('/chat', methods=['POST'])
 def chat():
+    with requests_in_progress.track(endpoint="chat"), request_seconds.time(endpoint="chat"):
+        response = answer_chat()
+    requests_total.inc(endpoint="chat", status=str(response[1]) if isinstance(response, tuple) else "200")
+    return response
+
+def answer_chat():
     try:
         data = request.get_json()
         
@@ -135,10 +252,11 @@ def chat():
             return jsonify({"error": "No message provided"}), 400
         
         message = data['message']
+        conversation_id = data.get('conversation_id')
         
         logger.info(f"Received message: {message}")
         
-        answer, theorem = generate_respond(message, use_chat_history= False)
+        answer, theorem = generate_respond(message, conversation_id)
         print(f"Generated response")
         
         return jsonify({
@@ -150,10 +268,44 @@ def chat():
         logger.info(f"ERROR: {str(e)}")
         return jsonify({"error": str(e)}), 500
 
+@app.route('/chat/stream', methods=['POST'])
+def chat_stream():
+    """Same as /chat, answered as Server-Sent Events: sources, token..., done (or error)."""
+    data = request.get_json(silent=True)
+
+    if not data or 'message' not in data:
+        logger.info("No message provided")
+        return jsonify({"error": "No message provided"}), 400
+
+    message = data['message']
+    conversation_id = data.get('conversation_id')
+    logger.info(f"Received message (stream): {message}")
+
+    def events():
+        status = "200"
+        with requests_in_progress.track(endpoint="chat_stream"), request_seconds.time(endpoint="chat_stream"):
+            try:
+                for event, payload in stream_respond(message, conversation_id):
+                    yield sse_event(event, payload)
+                yield sse_event("done", {})
+            except Exception as e:
+                status = "500"
+                logger.info(f"ERROR: {str(e)}")
+                yield sse_event("error", {"error": str(e)})
+        requests_total.inc(endpoint="chat_stream", status=status)
+
+    return Response(
+        stream_with_context(events()),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
 @app.teardown_appcontext
 def close_db(error):
     if error:
         logger.info(f"App error: {error}")
 
 if __name__ == "__main__":
+    if os.getenv("OLLAMA_WARM_UP", "1") == "1":
+        warm_up_models([llm_name], ollama_base_url)
     app.run(host='0.0.0.0', port=8000, debug=True)
\ No newline at end of file
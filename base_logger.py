@@ -7,7 +7,7 @@ logging.basicConfig(
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
     #filename='neo4j_debug.log',
     filename='site_debug.log',
-    filemode='w'
+    filemode='a'
 )#change for each task
 
 logger = logging.getLogger(__name__)
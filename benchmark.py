@@ -0,0 +1,311 @@
+"""Offline ingestion benchmark.
+
+Runs ingestion against a local fake Ollama server and an in-memory graph,
+so throughput can be measured without a GPU or neo4j. --path stream (the
+default) is what loader.py does: loader.process_file streaming pages into
+windows of chunks that are extracted, written and checkpointed. --path text
+is the whole-book read_pdf -> extract_from_text -> add_theorems/add_examples
+path:
+
+    python benchmark.py --pages 200 --latency 0.05 --workers 4
+"""
+import os
+import json
+import time
+import random
+import argparse
+import resource
+import tempfile
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import fitz
+
+import graph
+import loader
+import utils
+from cache import extraction_cache
+from manifest import RunManifest
+from run_report import run_report, read_report, summarize
+
+
+WORDS = "group ring field ideal kernel image homomorphism subgroup coset order prime module basis rank".split()
+
+
+class FakeOllamaHandler(BaseHTTPRequestHandler):
+    # Set on the server: latency (seconds per request), theorems/examples per response
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, payload, status=200):
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path == "/api/tags":
+            models = sorted(self.server.available | self.server.loaded)
+            self._send_json({"models": [{"name": model, "model": model} for model in models]})
+        elif self.path == "/api/ps":
+            self._send_json({"models": [{"name": model, "model": model} for model in sorted(self.server.loaded)]})
+        else:
+            self._send_json({"error": "not found"}, status=404)
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        request = json.loads(self.rfile.read(length) or b"{}")
+        time.sleep(self.server.latency)
+        if request.get("model"):
+            self.server.loaded.add(request["model"])
+        if self.path == "/api/generate":
+            self._send_json({"model": request.get("model", ""), "created_at": "", "response": "", "done": True})
+            return
+        if self.path != "/api/chat":
+            self._send_json({"error": "not found"}, status=404)
+            return
+
+        content = self.server.canned_response(json.dumps(request.get("messages", [])))
+        self.send_response(200)
+        self.send_header("Content-Type", "application/x-ndjson")
+        self.end_headers()
+        model = request.get("model", "")
+        lines = [
+            {"model": model, "created_at": "", "message": {"role": "assistant", "content": content}, "done": False},
+            {"model": model, "created_at": "", "message": {"role": "assistant", "content": ""}, "done": True,
+             "done_reason": "stop", "eval_count": len(content) // 4, "prompt_eval_count": 0},
+        ]
+        for line in lines:
+            self.wfile.write((json.dumps(line) + "\n").encode("utf-8"))
+
+
+class FakeOllamaServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, latency: float = 0.0, theorems: int = 2, examples: int = 1):
+        super().__init__(("127.0.0.1", 0), FakeOllamaHandler)
+        self.latency = latency
+        self.theorems = theorems
+        self.examples = examples
+        self.loaded = set()
+        # Pulled models, listed by /api/tags along with the loaded ones
+        self.available = set()
+        self._counter = 0
+        self._lock = threading.Lock()
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+    def canned_response(self, prompt: str) -> str:
+        with self._lock:
+            self._counter += 1
+            n = self._counter
+        return json.dumps({
+            "theorems": [
+                {"name": f"Theorem {n}.{i}", "statement": f"Statement {n}.{i}", "proof": "Not provided",
+                 "subject": "Algebra", "domain": "Group Theory", "dependencies": [f"Theorem {n}.0"] if i else [],
+                 "type": "Theorem"}
+                for i in range(self.theorems)
+            ],
+            "examples": [
+                {"name": f"Example {n}.{i}", "content": f"Worked example {n}.{i}", "subject": "Algebra",
+                 "domain": "Group Theory", "illustrates_theorems": [f"Theorem {n}.0"], "difficulty": "Easy"}
+                for i in range(self.examples)
+            ],
+        })
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+
+class InMemoryGraph:
+    """Stand-in for Neo4jGraph that only counts what would be written.
+
+    rows counts UNWIND rows only, schema queries and graph version bumps
+    are queries but write no rows.
+    """
+
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.queries = 0
+        self.rows = 0
+        self.seconds = 0.0
+        self._lock = threading.Lock()
+
+    def query(self, query: str, params: dict = None):
+        started = time.perf_counter()
+        time.sleep(self.latency)
+        with self._lock:
+            self.queries += 1
+            self.rows += len((params or {}).get("rows", []))
+            self.seconds += time.perf_counter() - started
+        return []
+
+
+def make_pdf(path: str, pages: int, seed: int = 0):
+    rng = random.Random(seed)
+    doc = fitz.open()
+    for page_num in range(pages):
+        lines = [f"Theorem {page_num}. Let G be a finite group."]
+        lines += [" ".join(rng.choice(WORDS) for _ in range(12)) + "." for _ in range(45)]
+        doc.new_page().insert_text((40, 40), "\n".join(lines), fontsize=6)
+    doc.save(path)
+    doc.close()
+
+
+def peak_rss_mb() -> float:
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def run_text(pdf_path: str, server_url: str, fake_graph: InMemoryGraph, workers: int, extract, batch_size: int) -> dict:
+    started = time.perf_counter()
+    with fitz.open(pdf_path) as doc:
+        page_count = len(doc)
+    text = utils.read_pdf(pdf_path)
+    read_seconds = time.perf_counter() - started
+
+    started = time.perf_counter()
+    chunk_count = len(utils.create_math_aware_splitter().split_text(text))
+    split_seconds = time.perf_counter() - started
+
+    started = time.perf_counter()
+    found_theorems, found_examples = utils.extract_from_text(
+        extract=extract, text=text, ollama_base_url=server_url, max_workers=workers
+    )
+    extract_seconds = time.perf_counter() - started
+
+    started = time.perf_counter()
+    rows_before = fake_graph.rows
+    loader.add_theorems(found_theorems, batch_size=batch_size)
+    loader.add_examples(found_examples, batch_size=batch_size)
+    # Wall time of the write calls, they run one after the other so it is also their summed time
+    write_seconds = time.perf_counter() - started
+    rows_written = fake_graph.rows - rows_before
+
+    return {
+        "path": "text",
+        "pages": page_count,
+        "chunks": chunk_count,
+        "theorems": len(found_theorems),
+        "examples": len(found_examples),
+        "rows_written": rows_written,
+        "db_queries": fake_graph.queries,
+        "seconds": read_seconds + split_seconds + extract_seconds + write_seconds,
+        "pages_per_s": page_count / read_seconds if read_seconds else 0.0,
+        "split_s": split_seconds,
+        "chunks_per_s": chunk_count / extract_seconds if extract_seconds else 0.0,
+        "rows_per_s": rows_written / write_seconds if write_seconds else 0.0,
+    }
+
+
+def run_stream(pdf_path: str, server_url: str, fake_graph: InMemoryGraph, extract, checkpoint_chunks: int, tmp_dir: str) -> dict:
+    # Window sizes, checkpoints and link resolution as in loader.py, with a throwaway manifest and run report
+    with fitz.open(pdf_path) as doc:
+        page_count = len(doc)
+    report_path = run_report.open(os.path.join(tmp_dir, "benchmark-report.jsonl"))
+    started = time.perf_counter()
+    try:
+        loader.process_file(pdf_path, extract=extract, manifest=RunManifest(os.path.join(tmp_dir, "manifest.json")),
+                            checkpoint_chunks=checkpoint_chunks, ollama_base_url=server_url)
+    finally:
+        seconds = time.perf_counter() - started
+        run_report.close()
+    records = read_report(report_path)
+    summary = summarize(records)
+    writes = summary["writes"]
+    # Time in the loader's write and link calls, like write_seconds in run_text (unrounded, the summary rounds to 0.1s)
+    write_seconds = sum(record.get("seconds", 0) for record in records if record["type"] in ("write", "links"))
+
+    return {
+        "path": "stream",
+        "pages": page_count,
+        "chunks": summary["chunks"],
+        "theorems": writes.get("theorem", {}).get("succeeded", 0),
+        "examples": writes.get("example", {}).get("succeeded", 0),
+        "rows_written": fake_graph.rows,
+        "db_queries": fake_graph.queries,
+        "seconds": seconds,
+        "pages_per_s": page_count / seconds if seconds else 0.0,
+        "chunks_per_s": summary["chunks"] / seconds if seconds else 0.0,
+        "rows_per_s": fake_graph.rows / write_seconds if write_seconds else 0.0,
+    }
+
+
+def run(pdf_path: str, latency: float, db_latency: float, workers: int, extract, theorems: int, examples: int, batch_size: int,
+        path: str = "stream", checkpoint_chunks: int = loader.ingest_checkpoint_chunks):
+    server = FakeOllamaServer(latency=latency, theorems=theorems, examples=examples).start()
+    fake_graph = InMemoryGraph(latency=db_latency)
+    graph.set_graph(fake_graph)
+    extraction_cache.enabled = False
+    loader.embed_at_ingest = False
+    # The per-endpoint semaphore would otherwise cap the fake server at OLLAMA_CONCURRENCY
+    utils.ollama_concurrency[server.url] = workers
+
+    try:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            if path == "stream":
+                report = run_stream(pdf_path, server.url, fake_graph, extract, checkpoint_chunks, tmp_dir)
+            else:
+                report = run_text(pdf_path, server.url, fake_graph, workers, extract, batch_size)
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    report["peak_rss_mb"] = peak_rss_mb()
+    return report
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Measure ingestion throughput with a fake Ollama server and in-memory graph")
+    parser.add_argument("--pdf", help="PDF to ingest, a synthetic one is generated when omitted")
+    parser.add_argument("--pages", type=int, default=100, help="pages in the synthetic PDF")
+    parser.add_argument("--latency", type=float, default=0.05, help="fake LLM seconds per request")
+    parser.add_argument("--db-latency", type=float, default=0.0, help="fake graph seconds per query")
+    parser.add_argument("--workers", type=int, default=4, help="concurrent extraction requests")
+    parser.add_argument("--extract", default="theorem,example", help="kinds to extract, comma separated")
+    parser.add_argument("--theorems", type=int, default=2, help="theorems in each canned response")
+    parser.add_argument("--examples", type=int, default=1, help="examples in each canned response")
+    parser.add_argument("--batch-size", type=int, default=loader.neo4j_batch_size, help="rows per UNWIND write (--path text, stream uses NEO4J_BATCH_SIZE)")
+    parser.add_argument("--path", choices=["stream", "text"], default="stream",
+                        help="loader.process_file (streamed pages, checkpointed windows) or whole-text extract_from_text")
+    parser.add_argument("--checkpoint-chunks", type=int, default=loader.ingest_checkpoint_chunks, help="chunks per window for --path stream")
+    parser.add_argument("--json", action="store_true", help="print the report as JSON")
+    args = parser.parse_args(argv)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        pdf_path = args.pdf
+        if not pdf_path:
+            pdf_path = os.path.join(tmp_dir, "benchmark.pdf")
+            make_pdf(pdf_path, args.pages)
+        report = run(
+            pdf_path=pdf_path,
+            latency=args.latency,
+            db_latency=args.db_latency,
+            workers=args.workers,
+            extract={kind.strip() for kind in args.extract.split(",") if kind.strip()},
+            theorems=args.theorems,
+            examples=args.examples,
+            batch_size=args.batch_size,
+            path=args.path,
+            checkpoint_chunks=args.checkpoint_chunks,
+        )
+
+    if args.json:
+        print(json.dumps(report, indent=2))
+        return
+    print(f"path:         {report['path']}, {report['seconds']:.2f}s")
+    print(f"pages:        {report['pages']} ({report['pages_per_s']:.1f} pages/s)")
+    split = f"split in {report['split_s']:.2f}s, " if "split_s" in report else ""
+    print(f"chunks:       {report['chunks']} ({split}extracted at {report['chunks_per_s']:.1f} chunks/s)")
+    print(f"extracted:    {report['theorems']} theorems, {report['examples']} examples")
+    print(f"written:      {report['rows_written']} rows in {report['db_queries']} queries ({report['rows_per_s']:.1f} rows/s)")
+    print(f"peak RSS:     {report['peak_rss_mb']:.1f} MB")
+
+
+if __name__ == "__main__":
+    main()
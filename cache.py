@@ -0,0 +1,294 @@
+import os
+import re
+import json
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import Any, Hashable, Optional, Tuple
+import numpy as np
+from dotenv import load_dotenv
+
+from base_logger import logger
+
+load_dotenv(".env")
+
+extraction_cache_dir = os.getenv("EXTRACTION_CACHE_DIR", ".cache/extraction")
+extraction_cache_max_mb = float(os.getenv("EXTRACTION_CACHE_MAX_MB", "512"))
+graph_version_check_seconds = float(os.getenv("GRAPH_VERSION_CHECK_SECONDS", "5"))
+
+
+class ExtractionCache:
+    """On-disk cache of raw LLM extraction output.
+
+    Entries are keyed by sha256(chunk, template, model, variant) and stored one
+    JSON file per key; variant is anything else that changes the output, like
+    the JSON schema of structured output. The raw response is kept (not the parsed objects) so a fix
+    in parse_response or the pydantic models applies to cached chunks too.
+    When the directory grows past max_bytes the least recently used files
+    (by mtime, refreshed on every hit) are removed.
+    """
+
+    def __init__(self, cache_dir: str = extraction_cache_dir, max_mb: float = extraction_cache_max_mb, enabled: bool = True):
+        self.cache_dir = cache_dir
+        self.max_bytes = int(max_mb * 1024 * 1024)
+        self.enabled = enabled
+        self.hits = 0
+        self.misses = 0
+        self._size = None
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def make_key(chunk: str, template: str, model: str, variant: str = "") -> str:
+        digest = hashlib.sha256()
+        # variant is left out when empty so keys written before it existed still match
+        for part in (model or "", template, chunk) + ((variant,) if variant else ()):
+            digest.update(part.encode("utf-8"))
+            digest.update(b"\0")
+        return digest.hexdigest()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, key[:2], key + ".json")
+
+    def get_entry(self, chunk: str, template: str, model: str, variant: str = "") -> Optional[dict]:
+        """The stored entry: "response", and "repairs" already tried on it (0 for older entries)."""
+        if not self.enabled:
+            return None
+        path = self._path(self.make_key(chunk, template, model, variant))
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                entry = json.load(f)
+            entry["response"]
+            os.utime(path)
+        except (OSError, ValueError, KeyError, TypeError):
+            with self._lock:
+                self.misses += 1
+            return None
+        with self._lock:
+            self.hits += 1
+        entry.setdefault("repairs", 0)
+        return entry
+
+    def get(self, chunk: str, template: str, model: str, variant: str = "") -> Optional[str]:
+        entry = self.get_entry(chunk, template, model, variant)
+        return entry["response"] if entry is not None else None
+
+    def put(self, chunk: str, template: str, model: str, response: str, variant: str = "", repairs: int = 0):
+        if not self.enabled:
+            return
+        path = self._path(self.make_key(chunk, template, model, variant))
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = f"{path}.{threading.get_ident()}.tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump({"model": model, "response": response, "repairs": repairs}, f)
+            # An overwritten entry only adds the difference in size
+            try:
+                replaced = os.path.getsize(path)
+            except OSError:
+                replaced = 0
+            os.replace(tmp_path, path)
+            written = os.path.getsize(path) - replaced
+        except OSError as e:
+            logger.warning(f"Failed to write extraction cache entry: {e}")
+            return
+        with self._lock:
+            if self._size is None:
+                self._size = self._disk_usage()
+            else:
+                self._size += written
+            if self._size > self.max_bytes:
+                self._evict()
+
+    def _entries(self):
+        for root, _, files in os.walk(self.cache_dir):
+            for name in files:
+                if name.endswith(".json"):
+                    path = os.path.join(root, name)
+                    try:
+                        stat = os.stat(path)
+                    except OSError:
+                        continue
+                    yield path, stat.st_size, stat.st_mtime
+
+    def _disk_usage(self) -> int:
+        return sum(size for _, size, _ in self._entries())
+
+    def _evict(self):
+        # Drop the oldest entries until we are back under 90% of the cap
+        target = int(self.max_bytes * 0.9)
+        removed = 0
+        for path, size, _ in sorted(self._entries(), key=lambda entry: entry[2]):
+            if self._size <= target:
+                break
+            try:
+                os.remove(path)
+                self._size -= size
+                removed += 1
+            except OSError:
+                continue
+        logger.info(f"Evicted {removed} extraction cache entries")
+
+    def clear(self):
+        removed = 0
+        with self._lock:
+            for path, _, _ in list(self._entries()):
+                try:
+                    os.remove(path)
+                    removed += 1
+                except OSError:
+                    continue
+            self._size = 0
+        logger.info(f"Cleared {removed} extraction cache entries")
+        return removed
+
+
+extraction_cache = ExtractionCache()
+
+
+class VersionedLRUCache:
+    """In-process LRU cache whose entries die when the graph version changes.
+
+    Every entry remembers the graph version it was read at. The owner checks
+    version_due() and passes the current version to set_version() (at most
+    every version_check_seconds), so validating a hit costs no query.
+    Entries also expire after ttl seconds as a safety net.
+    """
+
+    def __init__(self, max_entries: int = 1024, ttl: float = 3600, version_check_seconds: float = graph_version_check_seconds):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.version_check_seconds = version_check_seconds
+        self.version = None
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self._version_checked_at = 0.0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def version_due(self) -> bool:
+        return self.version is None or time.monotonic() - self._version_checked_at >= self.version_check_seconds
+
+    def set_version(self, version):
+        with self._lock:
+            self._version_checked_at = time.monotonic()
+            if version != self.version:
+                if self.version is not None:
+                    self.invalidations += 1
+                self.version = version
+                self._entries.clear()
+
+    def lookup(self, key: Hashable) -> Tuple[bool, Any]:
+        # Returns (found, value) so a cached None ("not in the graph") is still a hit
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                value, version, stored_at = entry
+                if version == self.version and time.monotonic() - stored_at < self.ttl:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return True, value
+                del self._entries[key]
+            self.misses += 1
+            return False, None
+
+    def put(self, key: Hashable, value: Any, version= None):
+        # version is the one seen before reading value, so data read across a bump isn't kept
+        with self._lock:
+            if version is not None and version != self.version:
+                return
+            self._entries[key] = (value, self.version, time.monotonic())
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self._entries),
+                "max_entries": self.max_entries,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations,
+                "graph_version": self.version,
+            }
+
+
+def normalize_question(question: str) -> str:
+    question = re.sub(r"\s+", " ", question.lower()).strip()
+    return question.strip(" ?!.,;:")
+
+
+def unit_vector(embedding) -> Optional[np.ndarray]:
+    vector = np.asarray(embedding, dtype=np.float32)
+    norm = float(np.linalg.norm(vector))
+    return vector / norm if norm else None
+
+
+class AnswerCache(VersionedLRUCache):
+    """Answers keyed by normalized question text, dropped on graph version change.
+
+    With a threshold set, a question that misses the exact key is compared
+    (cosine similarity of embeddings) to the cached ones and the closest
+    answer above the threshold is returned.
+    Values are (answer, sources, embedding).
+    """
+
+    def __init__(self, max_entries: int = 512, ttl: float = 86400, threshold: float = None,
+                 version_check_seconds: float = graph_version_check_seconds):
+        super().__init__(max_entries= max_entries, ttl= ttl, version_check_seconds= version_check_seconds)
+        self.threshold = threshold
+        self.similar_hits = 0
+
+    def put(self, key: Hashable, value: Any, version= None):
+        # Embeddings are kept normalized, so scoring every cached question is one matrix product
+        if value[2] is not None:
+            value = (value[0], value[1], unit_vector(value[2]))
+        super().put(key, value, version= version)
+
+    def lookup_similar(self, embedding) -> Tuple[bool, Any]:
+        if not self.threshold or embedding is None:
+            return False, None
+        query = unit_vector(embedding)
+        if query is None:
+            return False, None
+        # Only the candidates are collected under the lock, they are scored without holding it
+        with self._lock:
+            now = time.monotonic()
+            candidates = [
+                (key, value[2]) for key, (value, version, stored_at) in self._entries.items()
+                if version == self.version and now - stored_at < self.ttl
+                and value[2] is not None and value[2].shape == query.shape
+            ]
+        if not candidates:
+            return False, None
+        scores = np.stack([vector for _, vector in candidates]) @ query
+        best = int(np.argmax(scores))
+        if scores[best] < self.threshold:
+            return False, None
+        with self._lock:
+            entry = self._entries.get(candidates[best][0])
+            if entry is None:
+                return False, None
+            self._entries.move_to_end(candidates[best][0])
+            self.similar_hits += 1
+            # Counted as a hit: lookup() already counted this question as a miss
+            self.hits += 1
+            self.misses -= 1
+            return True, entry[0]
+
+    def stats(self) -> dict:
+        stats = super().stats()
+        stats["similar_hits"] = self.similar_hits
+        stats["threshold"] = self.threshold
+        return stats
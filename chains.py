@@ -1,26 +1,96 @@
-from langchain_ollama import OllamaEmbeddings
-from langchain_ollama import ChatOllama
-from langchain_neo4j import Neo4jVector
-from langchain_core.runnables import RunnableParallel, RunnablePassthrough
-from langchain_core.output_parsers import StrOutputParser
-from langchain_core.prompts import PromptTemplate
+import os
+import re
+import json
+import threading
+from dotenv import load_dotenv
+
 from base_logger import logger
 
+load_dotenv(".env")
+
+ollama_keep_alive = os.getenv("OLLAMA_KEEP_ALIVE", "30m")
+# huggingface name of the chat model tokenizer, e.g. Qwen/Qwen2-Math-7B-Instruct (needs transformers)
+tokenizer_name = os.getenv("TOKENIZER")
+
+_chains = {}
+_chains_lock = threading.Lock()
+_tokenizer = None
+_tokenizer_loaded = False
+_tokenizer_lock = threading.Lock()
+
 
 
 
 def load_embedding_model(logger=logger, config={}):
+    from langchain_ollama import OllamaEmbeddings
     embedding = OllamaEmbeddings(
         base_url=config["ollama_base_url"], model=config["llm"]
     )
-    dimension = 4096
+    dimension = config.get("dimension", 4096)
     logger.info("Embedding: Using Ollama")
     return embedding, dimension 
 
 
-def create_llm_chain(llm_name:str, ollama_base_url:str, template:str):
+# Token estimate without a tokenizer: up to 6 letters of a word, and every digit or symbol, count as one
+# token. A bit over llama/qwen on English, and doesn't undercount LaTeX ("\frac{a}{b}") the way chars/4 does.
+ESTIMATED_TOKEN = re.compile(r"[^\W\d_]{1,6}|\S")
+
+
+def get_tokenizer():
+    """The TOKENIZER huggingface tokenizer (matching CHAT_LLM), None when unset or unavailable."""
+    global _tokenizer, _tokenizer_loaded
+    if not _tokenizer_loaded:
+        with _tokenizer_lock:
+            if not _tokenizer_loaded:
+                if tokenizer_name:
+                    try:
+                        from transformers import AutoTokenizer
+                        _tokenizer = AutoTokenizer.from_pretrained(tokenizer_name)
+                        logger.info(f"Loaded tokenizer: {tokenizer_name}")
+                    except Exception as e:
+                        logger.warning(f"failed to load tokenizer {tokenizer_name}, estimating tokens. error: {e}")
+                _tokenizer_loaded = True
+    return _tokenizer
+
+
+def count_tokens(text: str) -> int:
+    if not text:
+        return 0
+    tokenizer = get_tokenizer()
+    if tokenizer is not None:
+        return len(tokenizer.encode(text, add_special_tokens=False))
+    return len(ESTIMATED_TOKEN.findall(text))
+
+
+def truncate_to_tokens(text: str, max_tokens: int) -> str:
+    """text cut down to at most max_tokens tokens."""
+    if max_tokens <= 0 or not text:
+        return ""
+    tokenizer = get_tokenizer()
+    if tokenizer is not None:
+        ids = tokenizer.encode(text, add_special_tokens=False)
+        return text if len(ids) <= max_tokens else tokenizer.decode(ids[:max_tokens])
+    for i, match in enumerate(ESTIMATED_TOKEN.finditer(text)):
+        if i == max_tokens:
+            return text[:match.start()]
+    return text
+
+
+def parse_keep_alive(keep_alive):
+    # Ollama takes durations ("30m") or seconds, -1 keeps the model loaded forever
     try:
-        llm =  ChatOllama(
+        return int(keep_alive)
+    except (TypeError, ValueError):
+        return keep_alive
+
+
+def create_llm_chain(llm_name:str, ollama_base_url:str, template:str, **params):
+    # langchain imports are deferred so importing this module stays cheap
+    from langchain_ollama import ChatOllama
+    from langchain_core.output_parsers import StrOutputParser
+    from langchain_core.prompts import PromptTemplate
+    try:
+        llm_params = dict(
             temperature=0,
             base_url=ollama_base_url,
             model=llm_name,
@@ -29,8 +99,11 @@ def create_llm_chain(llm_name:str, ollama_base_url:str, template:str):
             top_k=10,  # A higher value (100) will give more diverse answers, while a lower value (10) will be more conservative.
             top_p=0.3,  # Higher value (0.95) will lead to more diverse text, while a lower value (0.5) will generate more focused text.
             num_ctx=3072,  # Sets the size of the context window used to generate the next token.
-            num_predict=-1
+            num_predict=-1,
+            keep_alive=parse_keep_alive(ollama_keep_alive)
         )
+        llm_params.update(params)
+        llm =  ChatOllama(**llm_params)
         prompt = PromptTemplate(
             input_variables=["text"],
             template= template
@@ -41,6 +114,51 @@ def create_llm_chain(llm_name:str, ollama_base_url:str, template:str):
     except Exception as e:
         logger.info(f"failed to load llm. error: {e}")
 
+
+def get_llm_chain(llm_name:str, ollama_base_url:str, template:str, **params):
+    """Return a prebuilt chain for (model, url, template, params), building it once.
+
+    Chains hold no per-call state, so one instance is shared by every
+    request and extraction thread in the process.
+    """
+    # Dict params (a JSON schema format) aren't hashable, they are keyed by their JSON
+    key = (llm_name, ollama_base_url, template, tuple(sorted(
+        (name, json.dumps(value, sort_keys=True) if isinstance(value, (dict, list)) else value) for name, value in params.items()
+    )))
+    chain = _chains.get(key)
+    if chain is None:
+        with _chains_lock:
+            chain = _chains.get(key)
+            if chain is None:
+                chain = create_llm_chain(llm_name, ollama_base_url, template, **params)
+                if chain is not None:
+                    _chains[key] = chain
+    return chain
+
+
+def invoke_with_usage(chain, inputs: dict):
+    """Invoke a get_llm_chain chain, returning (text, output tokens Ollama reported as eval_count)."""
+    from langchain_core.runnables import RunnableSequence
+    message = RunnableSequence(chain.first, *chain.middle).invoke(inputs)
+    usage = message.usage_metadata or {}
+    output_tokens = usage.get("output_tokens", message.response_metadata.get("eval_count", 0))
+    return chain.last.invoke(message), output_tokens
+
+
+def warm_up_models(models, ollama_base_url:str, keep_alive= ollama_keep_alive, logger=logger):
+    """Load models into Ollama ahead of the first request and keep them resident.
+
+    An empty generate request only loads the model, it doesn't run inference.
+    """
+    import ollama
+    client = ollama.Client(host=ollama_base_url)
+    for model in dict.fromkeys(m for m in models if m):
+        try:
+            client.generate(model=model, prompt="", keep_alive=parse_keep_alive(keep_alive))
+            logger.info(f"Warmed up llm: {model} (keep_alive={keep_alive})")
+        except Exception as e:
+            logger.info(f"failed to warm up llm {model}. error: {e}")
+
 # def configure_llm_only_chain(llm):
 #     template = """
 #     You are a helpful assistant that helps a support agent with answering math questions.
@@ -0,0 +1,206 @@
+import os
+import asyncio
+import threading
+from typing import Callable, Hashable, Tuple
+from dotenv import load_dotenv
+
+from base_logger import logger
+
+load_dotenv(".env")
+
+coalesce_requests = os.getenv("COALESCE_REQUESTS", "1") == "1"
+
+
+class Flight:
+    """One in-flight generation: the events ("sources", theorems) and ("token", text)
+    published by its producer, replayed to every request that joined.
+
+    subscribers is how many requests are following it; cancelled is set
+    once they all left, the producer stops at its next token.
+    """
+
+    def __init__(self):
+        self.events = []
+        self.done = False
+        self.error = None
+        self.subscribers = 0
+        self.cancelled = False
+        self._condition = threading.Condition()
+
+    def publish(self, event: str, payload):
+        with self._condition:
+            self.events.append((event, payload))
+            self._condition.notify_all()
+
+    def finish(self, error: BaseException = None):
+        with self._condition:
+            self.done = True
+            self.error = error
+            self._condition.notify_all()
+
+    def follow(self):
+        """Yield the events published so far, then the new ones until the flight ends."""
+        seen = 0
+        while True:
+            with self._condition:
+                while seen >= len(self.events) and not self.done:
+                    self._condition.wait()
+                events, done, error = self.events[seen:], self.done, self.error
+            seen += len(events)
+            yield from events
+            if done:
+                if error is not None:
+                    raise RuntimeError(f"shared generation failed: {error!r}")
+                return
+
+    def result(self) -> Tuple[str, list]:
+        return collect(self.follow())
+
+
+def collect(events) -> Tuple[str, list]:
+    sources, tokens = [], []
+    for event, payload in events:
+        if event == "sources":
+            sources = payload
+        else:
+            tokens.append(payload)
+    return "".join(tokens), sources
+
+
+class SingleFlight:
+    """Identical requests in flight at the same time share one generation.
+
+    join(key, produce) returns (flight, leader). The first request for a key
+    starts produce(flight) in the background, the producer publishes into
+    the flight; every request, the leader included, follows the flight and
+    calls leave() when done with it, even when its client went away. The
+    generation isn't tied to any one connection: a client that disconnects
+    only unsubscribes, the producer is cancelled when nobody is left.
+    Keys are dropped on finish, so only concurrent duplicates are coalesced
+    (answers that are already done come from the answer cache).
+    """
+
+    flight_class = Flight
+
+    def __init__(self, enabled: bool = coalesce_requests):
+        self.enabled = enabled
+        self.leaders = 0
+        self.followers = 0
+        self._flights = {}
+        self._lock = threading.Lock()
+
+    def join(self, key: Hashable, produce: Callable):
+        with self._lock:
+            flight = self._flights.get(key) if self.enabled else None
+            if flight is not None:
+                flight.subscribers += 1
+                self.followers += 1
+                return flight, False
+            flight = self.flight_class()
+            flight.subscribers = 1
+            if self.enabled:
+                self._flights[key] = flight
+            self.leaders += 1
+        self._start(key, flight, produce)
+        return flight, True
+
+    def _start(self, key: Hashable, flight, produce: Callable):
+        def run():
+            error = None
+            try:
+                produce(flight)
+            except Exception as e:
+                error = e
+            finally:
+                self.finish(key, flight, error)
+        threading.Thread(target=run, name="generate", daemon=True).start()
+
+    def _cancel(self, flight):
+        # The producer checks flight.cancelled between tokens
+        pass
+
+    def leave(self, key: Hashable, flight):
+        with self._lock:
+            flight.subscribers -= 1
+            if flight.subscribers > 0 or flight.done:
+                return
+            flight.cancelled = True
+            if self._flights.get(key) is flight:
+                del self._flights[key]
+        logger.info("every request left, generation cancelled")
+        self._cancel(flight)
+
+    def _remove(self, key: Hashable, flight):
+        with self._lock:
+            if self._flights.get(key) is flight:
+                del self._flights[key]
+
+    def finish(self, key: Hashable, flight, error: BaseException = None):
+        self._remove(key, flight)
+        flight.finish(error)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "enabled": self.enabled,
+                "in_flight": len(self._flights),
+                "leaders": self.leaders,
+                "followers": self.followers,
+            }
+
+
+class AsyncFlight(Flight):
+    """Flight for requests of one event loop."""
+
+    def __init__(self):
+        super().__init__()
+        self._changed = asyncio.Event()
+
+    def publish(self, event: str, payload):
+        self.events.append((event, payload))
+        self._changed.set()
+
+    def finish(self, error: BaseException = None):
+        self.done = True
+        self.error = error
+        self._changed.set()
+
+    async def follow(self):
+        seen = 0
+        while True:
+            while seen >= len(self.events) and not self.done:
+                self._changed.clear()
+                await self._changed.wait()
+            events, done, error = self.events[seen:], self.done, self.error
+            seen += len(events)
+            for event in events:
+                yield event
+            if done:
+                if error is not None:
+                    raise RuntimeError(f"shared generation failed: {error!r}")
+                return
+
+    async def result(self) -> Tuple[str, list]:
+        return collect([event async for event in self.follow()])
+
+
+class AsyncSingleFlight(SingleFlight):
+    """SingleFlight whose producers are coroutine functions, run as tasks of the event loop."""
+
+    flight_class = AsyncFlight
+
+    def _start(self, key: Hashable, flight, produce: Callable):
+        async def run():
+            error = None
+            try:
+                await produce(flight)
+            except asyncio.CancelledError:
+                pass
+            except Exception as e:
+                error = e
+            finally:
+                self.finish(key, flight, error)
+        flight.task = asyncio.create_task(run())
+
+    def _cancel(self, flight):
+        flight.task.cancel()
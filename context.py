@@ -0,0 +1,173 @@
+import os
+import re
+from typing import List, Dict, Any, Tuple
+from dotenv import load_dotenv
+
+from base_logger import logger
+from chains import count_tokens, truncate_to_tokens, get_tokenizer
+
+load_dotenv(".env")
+
+# Prompt tokens for answer_with_rag, what's left of num_ctx (3072) is room for the answer
+prompt_token_budget = int(os.getenv("PROMPT_TOKEN_BUDGET", "2304"))
+# A proof is only included when at least this many of its tokens fit
+min_proof_tokens = int(os.getenv("MIN_PROOF_TOKENS", "32"))
+# Share of the budget kept free when tokens are estimated (no TOKENIZER), the estimate can be off on LaTeX
+token_estimate_margin = float(os.getenv("TOKEN_ESTIMATE_MARGIN", "0.1"))
+
+
+def template_tokens(template: str) -> int:
+    return count_tokens(re.sub(r"\{\w+\}", "", template))
+
+
+def _words(text: str) -> set:
+    return set(re.findall(r"[a-z]{3,}", (text or "").lower()))
+
+
+def _dependencies(theorems: List[Dict[str, Any]]) -> Dict[str, Dict[str, Any]]:
+    # Dependencies that weren't asked for themselves, each once
+    asked = {t['name'] for t in theorems}
+    dependencies = {}
+    for t in theorems:
+        for dep in t.get('dependencies') or []:
+            if dep['name'] not in asked:
+                dependencies.setdefault(dep['name'], dep)
+    return dependencies
+
+
+def _pieces(theorems: List[Dict[str, Any]], dependencies: List[Dict[str, Any]], question: str) -> List[Tuple[str, str, bool]]:
+    """(theorem name, part, trimmable) for every part of the context that could be included, by priority.
+
+    Every statement comes before any proof or example: asked-for theorems in
+    retrieval order, then dependencies ranked by how many words of their
+    statement appear in the question. Proofs and examples follow in the
+    same order.
+    """
+    question_words = _words(question)
+    ranked = sorted(dependencies, key=lambda dep: -len(question_words & _words(dep.get('statement'))))
+    pieces = [(t['name'], "statement", False) for t in theorems]
+    pieces += [(dep['name'], "statement", False) for dep in ranked]
+    pieces += [(t['name'], "proof", True) for t in theorems if t.get('proof')]
+    pieces += [(t['name'], f"example:{example['name']}", True) for t in theorems for example in t.get('examples') or []]
+    pieces += [(dep['name'], "proof", True) for dep in ranked if dep.get('proof')]
+    return pieces
+
+
+def _text(records: Dict[str, Dict[str, Any]], name: str, part: str) -> str:
+    record = records[name]
+    if part == "statement":
+        return record.get('statement') or ""
+    if part == "proof":
+        return record.get('proof') or ""
+    example_name = part.split(":", 1)[1]
+    for example in record.get('examples') or []:
+        if example['name'] == example_name:
+            return example.get('content') or ""
+    return ""
+
+
+def _line(record: Dict[str, Any], part: str, text: str) -> str:
+    """The line _render writes for one part of a theorem."""
+    if part == "statement":
+        label = f" ({record['type']})" if record.get('type') else ""
+        return f"{record['name']}{label}: {text}"
+    if part == "proof":
+        return f"Proof: {text}"
+    example_name = part.split(":", 1)[1]
+    example = next((e for e in record.get('examples') or [] if e['name'] == example_name), {})
+    difficulty = f" ({example['difficulty']})" if example.get('difficulty') else ""
+    return f"Example{difficulty}: {text}"
+
+
+def _depends_on(record: Dict[str, Any]) -> str:
+    depends_on = [dep['name'] for dep in record.get('dependencies') or []]
+    return f"Depends on: {', '.join(depends_on)}" if depends_on else ""
+
+
+def _cost(record: Dict[str, Any], part: str, text: str) -> int:
+    # A statement opens the block, so it also pays for the "Depends on" line and the blank line before it
+    if part == "statement":
+        return count_tokens(_line(record, part, text)) + count_tokens(_depends_on(record)) + 3
+    return count_tokens(_line(record, part, text)) + 1
+
+
+def _render(theorems: List[Dict[str, Any]], dependencies: List[Dict[str, Any]], kept: Dict[Tuple[str, str], str]) -> str:
+    blocks = []
+    for t in theorems + dependencies:
+        if (t['name'], "statement") not in kept:
+            continue
+        lines = [_line(t, "statement", kept[(t['name'], "statement")])]
+        if (t['name'], "proof") in kept:
+            lines.append(_line(t, "proof", kept[(t['name'], "proof")]))
+        if _depends_on(t):
+            lines.append(_depends_on(t))
+        for example in t.get('examples') or []:
+            part = f"example:{example['name']}"
+            if (t['name'], part) in kept:
+                lines.append(_line(t, part, kept[(t['name'], part)]))
+        blocks.append("\n".join(lines))
+    return "\n\n".join(blocks)
+
+
+def pack_theorems(theorems: List[Dict[str, Any]], question: str, budget: int) -> Tuple[str, Dict[str, int]]:
+    """Format retrieved theorems compactly within budget tokens.
+
+    Parts are added by priority: asked-for statements, dependency
+    statements, then the asked-for proofs and examples and the dependency
+    proofs in what is left. A proof or example that doesn't fit whole is
+    cut to the room left (if at least min_proof_tokens); a statement that
+    doesn't fit is left out.
+    Returns the context and what was trimmed or dropped.
+    """
+    dependencies = list(_dependencies(theorems).values())
+    records = {t['name']: t for t in dependencies + theorems}
+
+    kept = {}
+    used = 0
+    trimmed = dropped = 0
+    for name, part, trimmable in _pieces(theorems, dependencies, question):
+        if part != "statement" and (name, "statement") not in kept:
+            continue
+        text = _text(records, name, part)
+        if not text:
+            continue
+        # Charged as rendered, with the name, type label, "Proof: " and separators
+        tokens = _cost(records[name], part, text)
+        overhead = _cost(records[name], part, " …")
+        if used + tokens <= budget:
+            kept[(name, part)] = text
+            used += tokens
+        elif trimmable and budget - used - overhead >= min_proof_tokens:
+            cut = truncate_to_tokens(text, budget - used - overhead) + " …"
+            kept[(name, part)] = cut
+            used += _cost(records[name], part, cut)
+            trimmed += 1
+        else:
+            dropped += 1
+
+    context = _render(theorems, dependencies, kept)
+    return context, {"trimmed": trimmed, "dropped": dropped}
+
+
+def pack_prompt(template: str, theorems: List[Dict[str, Any]], question: str, chat_history: str,
+                budget: int = prompt_token_budget, logger= logger) -> Tuple[str, Dict[str, int]]:
+    """Pack theorems into what the prompt budget leaves after the template, history and question.
+
+    Returns the theorems context and the tokens each prompt section used.
+    Without a tokenizer, token_estimate_margin of the budget is left unused.
+    """
+    if get_tokenizer() is None:
+        budget = int(budget * (1 - token_estimate_margin))
+    report = {
+        "template": template_tokens(template),
+        "chat_history": count_tokens(chat_history),
+        "question": count_tokens(question),
+    }
+    room = budget - sum(report.values())
+    context, packing = pack_theorems(theorems, question, max(0, room))
+    report["theorems"] = count_tokens(context)
+    report["total"] = sum(report.values())
+    report["budget"] = budget
+    report.update(packing)
+    logger.info(f"Prompt tokens: {report}")
+    return context, report
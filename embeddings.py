@@ -0,0 +1,127 @@
+import os
+import threading
+from typing import List, Dict
+from dotenv import load_dotenv
+
+from base_logger import logger
+from chains import load_embedding_model
+from graph import get_graph, async_query
+from theorem import Theorem
+from example import Example
+
+load_dotenv(".env")
+
+ollama_base_url = os.getenv("OLLAMA_BASE_URL")
+embedding_model_name = os.getenv("EMBEDDING_MODEL", os.getenv("LLM"))
+embedding_dimension = int(os.getenv("EMBEDDING_DIMENSION", "4096"))
+embedding_batch_size = int(os.getenv("EMBEDDING_BATCH_SIZE", "64"))
+vector_top_k = int(os.getenv("VECTOR_TOP_K", "3"))
+vector_min_score = float(os.getenv("VECTOR_MIN_SCORE", "0.7"))
+
+# label -> (vector index name, property embedded)
+VECTOR_INDEXES = {
+    "Theorem": ("theorem_embedding", "statement"),
+    "Example": ("example_embedding", "content"),
+}
+
+_embedding_model = None
+_embedding_model_lock = threading.Lock()
+
+
+def get_embedding_model():
+    global _embedding_model
+    if _embedding_model is None:
+        with _embedding_model_lock:
+            if _embedding_model is None:
+                _embedding_model, _ = load_embedding_model(config={
+                    "ollama_base_url": ollama_base_url,
+                    "llm": embedding_model_name,
+                    "dimension": embedding_dimension
+                })
+    return _embedding_model
+
+
+def vector_index_queries(dimension: int = embedding_dimension) -> List[str]:
+    # Index options can't be parameters, dimension is formatted in as an int
+    return [
+        f"""CREATE VECTOR INDEX {index_name} IF NOT EXISTS FOR (n:{label}) ON (n.embedding)
+        OPTIONS {{indexConfig: {{`vector.dimensions`: {int(dimension)}, `vector.similarity_function`: 'cosine'}}}}"""
+        for label, (index_name, _) in VECTOR_INDEXES.items()
+    ]
+
+
+def embed_rows(label: str, rows: List[Dict[str, str]], batch_size: int = embedding_batch_size, graph= None) -> int:
+    """Embed rows of {'name', 'text'} with one embedding call and one UNWIND write per batch.
+
+    Returns how many nodes got an embedding.
+    """
+    graph = graph or get_graph()
+    model = get_embedding_model()
+    query = f"""
+    UNWIND $rows AS row
+    MATCH (n:{label} {{name: row.name}})
+    SET n.embedding = row.embedding
+    """
+    written = 0
+    for i in range(0, len(rows), max(1, batch_size)):
+        batch = [row for row in rows[i:i + max(1, batch_size)] if row['text'] and row['text'].strip()]
+        if not batch:
+            continue
+        vectors = model.embed_documents([row['text'] for row in batch])
+        graph.query(query, params={'rows': [
+            {'name': row['name'], 'embedding': vector} for row, vector in zip(batch, vectors)
+        ]})
+        written += len(batch)
+    return written
+
+
+def embed_theorems(theorems: List[Theorem], batch_size: int = embedding_batch_size) -> int:
+    return embed_rows("Theorem", [{'name': t.name, 'text': t.statement} for t in theorems], batch_size)
+
+
+def embed_examples(examples: List[Example], batch_size: int = embedding_batch_size) -> int:
+    return embed_rows("Example", [{'name': e.name, 'text': e.content} for e in examples], batch_size)
+
+
+def backfill_embeddings(batch_size: int = embedding_batch_size, logger= logger) -> Dict[str, int]:
+    """Embed every Theorem/Example that has text but no embedding yet, a batch at a time."""
+    graph = get_graph()
+    totals = {}
+    for label, (_, text_property) in VECTOR_INDEXES.items():
+        query = f"""
+        MATCH (n:{label})
+        WHERE n.embedding IS NULL AND n.{text_property} IS NOT NULL AND trim(n.{text_property}) <> ''
+        RETURN n.name AS name, n.{text_property} AS text
+        LIMIT $limit
+        """
+        totals[label] = 0
+        while True:
+            rows = graph.query(query, params={'limit': batch_size})
+            if not rows:
+                break
+            written = embed_rows(label, rows, batch_size, graph)
+            if not written:
+                break
+            totals[label] += written
+            logger.info(f"Backfilled {totals[label]} {label} embedding(s)")
+    return totals
+
+
+SIMILAR_THEOREMS_QUERY = """
+CALL db.index.vector.queryNodes('theorem_embedding', $k, $embedding) YIELD node, score
+WHERE score >= $min_score
+RETURN node.name AS name, score
+ORDER BY score DESC
+"""
+
+
+def similar_theorem_names(question: str, k: int = vector_top_k, min_score: float = vector_min_score) -> List[str]:
+    embedding = get_embedding_model().embed_query(question)
+    records = get_graph().query(SIMILAR_THEOREMS_QUERY, params={'k': k, 'embedding': embedding, 'min_score': min_score})
+    return [record['name'] for record in records]
+
+
+async def asimilar_theorem_names(question: str, k: int = vector_top_k, min_score: float = vector_min_score) -> List[str]:
+    embedding = await get_embedding_model().aembed_query(question)
+    records = await async_query(SIMILAR_THEOREMS_QUERY, params={'k': k, 'embedding': embedding, 'min_score': min_score})
+    return [record['name'] for record in records]
@@ -0,0 +1,91 @@
+import os
+import threading
+from dotenv import load_dotenv
+
+from base_logger import logger
+
+load_dotenv(".env")
+
+neo4j_url = os.getenv("NEO4J_URI")
+neo4j_username = os.getenv("NEO4J_USERNAME")
+neo4j_password = os.getenv("NEO4J_PASSWORD")
+
+_graph = None
+_graph_lock = threading.Lock()
+_async_driver = None
+
+
+def get_graph():
+    """Return the process-wide Neo4jGraph, connecting on first use.
+
+    langchain_neo4j is only imported here so modules that never touch the
+    database (and tests/tools importing them) don't pay for it.
+    """
+    global _graph
+    if _graph is None:
+        with _graph_lock:
+            if _graph is None:
+                from langchain_neo4j import Neo4jGraph
+                _graph = Neo4jGraph(
+                    url=neo4j_url, username=neo4j_username, password=neo4j_password, refresh_schema=False
+                )
+                logger.info("Connected to neo4j.")
+    return _graph
+
+
+def set_graph(graph):
+    # Swap in another object with a .query(query, params) method, e.g. an in-memory stand-in
+    global _graph
+    with _graph_lock:
+        _graph = graph
+
+
+# The loader bumps this counter on every write, readers use it to drop cached graph data
+BUMP_GRAPH_VERSION_QUERY = """
+MERGE (v:GraphVersion {id: 'graph'})
+SET v.version = coalesce(v.version, 0) + 1
+RETURN v.version AS version
+"""
+
+GRAPH_VERSION_QUERY = """
+MATCH (v:GraphVersion {id: 'graph'})
+RETURN v.version AS version
+"""
+
+
+def bump_graph_version(graph= None) -> int:
+    result = (graph or get_graph()).query(BUMP_GRAPH_VERSION_QUERY)
+    return result[0]['version'] if result else 0
+
+
+def get_graph_version(graph= None) -> int:
+    result = (graph or get_graph()).query(GRAPH_VERSION_QUERY)
+    return result[0]['version'] if result else 0
+
+
+async def aget_graph_version() -> int:
+    result = await async_query(GRAPH_VERSION_QUERY)
+    return result[0]['version'] if result else 0
+
+
+def get_async_driver():
+    """Return the process-wide async neo4j driver, created on first use."""
+    global _async_driver
+    if _async_driver is None:
+        from neo4j import AsyncGraphDatabase
+        _async_driver = AsyncGraphDatabase.driver(neo4j_url, auth=(neo4j_username, neo4j_password))
+        logger.info("Created async neo4j driver.")
+    return _async_driver
+
+
+async def async_query(query: str, params: dict = None):
+    # Same return shape as Neo4jGraph.query: a list of plain dicts
+    result = await get_async_driver().execute_query(query, params or {})
+    return [record.data() for record in result.records]
+
+
+async def close_async_driver():
+    global _async_driver
+    if _async_driver is not None:
+        await _async_driver.close()
+        _async_driver = None
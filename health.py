@@ -0,0 +1,187 @@
+import os
+import time
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout
+from typing import Callable, Dict, List
+from dotenv import load_dotenv
+
+from base_logger import logger
+from graph import get_graph, async_query
+from chains import warm_up_models
+
+load_dotenv(".env")
+
+ollama_base_url = os.getenv("OLLAMA_BASE_URL")
+health_cache_seconds = float(os.getenv("HEALTH_CACHE_SECONDS", "5"))
+health_timeout = float(os.getenv("HEALTH_TIMEOUT", "2"))
+# Models the chat server uses, they have to be pulled in Ollama for the node to be ready
+readiness_models = [model.strip() for model in os.getenv(
+    "READINESS_MODELS", os.getenv("CHAT_LLM", "")
+).split(",") if model.strip()]
+
+PING_QUERY = "RETURN 1 AS ok"
+
+
+def model_tag(name: str) -> str:
+    # Ollama reports "llama3.1:latest" for a model configured as "llama3.1"
+    return name if ":" in name else f"{name}:latest"
+
+
+def loaded_models(base_url: str = ollama_base_url, timeout: float = health_timeout) -> List[str]:
+    import ollama
+    client = ollama.Client(host=base_url, timeout=timeout)
+    return [model.model or model.name for model in client.ps().models]
+
+
+def available_models(base_url: str = ollama_base_url, timeout: float = health_timeout) -> List[str]:
+    import ollama
+    client = ollama.Client(host=base_url, timeout=timeout)
+    return [model.model for model in client.list().models]
+
+
+_warming = set()
+_warming_lock = threading.Lock()
+
+
+def rewarm_models(models: List[str], base_url: str = ollama_base_url):
+    """Load models again in the background, once at a time per model."""
+    with _warming_lock:
+        models = [model for model in models if model not in _warming]
+        _warming.update(models)
+    if not models:
+        return
+
+    def run():
+        try:
+            warm_up_models(models, base_url)
+        finally:
+            with _warming_lock:
+                _warming.difference_update(models)
+    threading.Thread(target=run, name="warm-up", daemon=True).start()
+
+
+def check_ollama(base_url: str = ollama_base_url, models: List[str] = readiness_models, timeout: float = health_timeout) -> dict:
+    """Ready when every model is available in Ollama (/api/tags).
+
+    A model that was unloaded after OLLAMA_KEEP_ALIVE of idling doesn't
+    make the node unready, it is warmed up again and reported as "warming";
+    otherwise a load balancer would stop sending the traffic that reloads it.
+    """
+    available = {model_tag(name) for name in available_models(base_url, timeout)}
+    missing = [model for model in models if model_tag(model) not in available]
+    loaded = {model_tag(name) for name in loaded_models(base_url, timeout)}
+    warming = [model for model in models if model_tag(model) in available and model_tag(model) not in loaded]
+    if warming:
+        rewarm_models(warming, base_url)
+    return {"ok": not missing, "missing": missing, "loaded": sorted(loaded), "warming": warming}
+
+
+def check_neo4j() -> dict:
+    get_graph().query(PING_QUERY)
+    return {"ok": True}
+
+
+async def acheck_neo4j() -> dict:
+    await async_query(PING_QUERY)
+    return {"ok": True}
+
+
+def _result(started: float, outcome: dict = None, error: str = None) -> dict:
+    result = dict(outcome or {"ok": False})
+    if error:
+        result.update(ok=False, error=error)
+    result["latency_ms"] = round((time.perf_counter() - started) * 1000, 1)
+    return result
+
+
+class HealthChecker:
+    """Runs the readiness probes in parallel and keeps the report for cache_seconds.
+
+    A probe returns a dict with at least "ok"; one that raises or takes
+    longer than timeout counts as failed. Every probe gets its round-trip
+    latency_ms. Load balancers polling /ready get the cached report, so
+    probing doesn't add load on neo4j or Ollama.
+    """
+
+    def __init__(self, probes: Dict[str, Callable[[], dict]], cache_seconds: float = health_cache_seconds,
+                 timeout: float = health_timeout):
+        self.probes = probes
+        self.cache_seconds = cache_seconds
+        self.timeout = timeout
+        self._report = None
+        self._checked_at = 0.0
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=max(1, len(probes)), thread_name_prefix="health")
+
+    def _fresh(self):
+        if self._report is not None and time.monotonic() - self._checked_at < self.cache_seconds:
+            return dict(self._report, cached=True)
+        return None
+
+    def _store(self, checks: Dict[str, dict]) -> dict:
+        self._report = {
+            "status": "ready" if all(check["ok"] for check in checks.values()) else "degraded",
+            "checks": checks,
+            "checked_at": time.time(),
+        }
+        self._checked_at = time.monotonic()
+        failed = {name: check.get("error") or check for name, check in checks.items() if not check["ok"]}
+        if failed:
+            logger.warning(f"Readiness check failed: {failed}")
+        return dict(self._report, cached=False)
+
+    def _probe(self, probe) -> dict:
+        started = time.perf_counter()
+        try:
+            return _result(started, probe())
+        except Exception as e:
+            return _result(started, error=str(e))
+
+    def check(self) -> dict:
+        # One request probes at a time, the others wait for its report
+        with self._lock:
+            report = self._fresh()
+            if report is not None:
+                return report
+            started = time.perf_counter()
+            futures = {name: self._executor.submit(self._probe, probe) for name, probe in self.probes.items()}
+            checks = {}
+            for name, future in futures.items():
+                try:
+                    checks[name] = future.result(timeout=max(0.0, self.timeout - (time.perf_counter() - started)))
+                except FutureTimeout:
+                    checks[name] = {"ok": False, "error": f"timed out after {self.timeout}s", "latency_ms": round(self.timeout * 1000, 1)}
+            return self._store(checks)
+
+
+class AsyncHealthChecker(HealthChecker):
+    """HealthChecker for the async server, probes are coroutine functions
+    (or plain functions, run in a thread)."""
+
+    def __init__(self, probes: Dict[str, Callable], cache_seconds: float = health_cache_seconds,
+                 timeout: float = health_timeout):
+        super().__init__(probes, cache_seconds, timeout)
+        self._alock = asyncio.Lock()
+
+    async def _aprobe(self, probe) -> dict:
+        started = time.perf_counter()
+        try:
+            if asyncio.iscoroutinefunction(probe):
+                outcome = await asyncio.wait_for(probe(), self.timeout)
+            else:
+                outcome = await asyncio.wait_for(asyncio.to_thread(probe), self.timeout)
+            return _result(started, outcome)
+        except asyncio.TimeoutError:
+            return _result(started, error=f"timed out after {self.timeout}s")
+        except Exception as e:
+            return _result(started, error=str(e))
+
+    async def acheck(self) -> dict:
+        async with self._alock:
+            report = self._fresh()
+            if report is not None:
+                return report
+            names = list(self.probes)
+            results = await asyncio.gather(*(self._aprobe(self.probes[name]) for name in names))
+            return self._store(dict(zip(names, results)))
@@ -0,0 +1,224 @@
+import os
+import time
+import sqlite3
+import threading
+from collections import OrderedDict
+from typing import List, Tuple
+from dotenv import load_dotenv
+
+from base_logger import logger
+from chains import get_llm_chain, count_tokens
+from templates import templates
+
+load_dotenv(".env")
+
+ollama_base_url = os.getenv("OLLAMA_BASE_URL")
+chat_history_backend = os.getenv("CHAT_HISTORY_BACKEND", "memory")
+chat_history_db = os.getenv("CHAT_HISTORY_DB", ".cache/chat_history.sqlite3")
+chat_history_tokens = int(os.getenv("CHAT_HISTORY_TOKENS", "1024"))
+chat_history_summary_tokens = int(os.getenv("CHAT_HISTORY_SUMMARY_TOKENS", "256"))
+chat_history_summarize = os.getenv("CHAT_HISTORY_SUMMARIZE", "0") == "1"
+chat_history_max_conversations = int(os.getenv("CHAT_HISTORY_MAX_CONVERSATIONS", "1000"))
+summary_llm_name = os.getenv("CHAT_HISTORY_SUMMARY_LLM", os.getenv("CHAT_LLM"))
+
+Turn = Tuple[str, str]
+
+
+class InMemoryHistoryStore:
+    """Turns and rolling summary of each conversation, kept in process memory.
+
+    Past max_conversations the least recently used conversation is dropped.
+    """
+
+    def __init__(self, max_conversations: int = chat_history_max_conversations):
+        self.max_conversations = max_conversations
+        self._conversations = OrderedDict()
+        self._lock = threading.Lock()
+
+    def load(self, conversation_id: str) -> Tuple[str, List[Turn]]:
+        with self._lock:
+            conversation = self._conversations.get(conversation_id)
+            if conversation is None:
+                return "", []
+            self._conversations.move_to_end(conversation_id)
+            return conversation["summary"], list(conversation["turns"])
+
+    def append(self, conversation_id: str, question: str, answer: str):
+        with self._lock:
+            conversation = self._conversations.setdefault(conversation_id, {"summary": "", "turns": []})
+            conversation["turns"].append((question, answer))
+            self._conversations.move_to_end(conversation_id)
+            while len(self._conversations) > self.max_conversations:
+                self._conversations.popitem(last=False)
+
+    def compact(self, conversation_id: str, summary: str, drop: int):
+        # Replace the summary and forget the drop oldest turns
+        with self._lock:
+            conversation = self._conversations.get(conversation_id)
+            if conversation is not None:
+                conversation["summary"] = summary
+                del conversation["turns"][:drop]
+
+    def clear(self, conversation_id: str):
+        with self._lock:
+            self._conversations.pop(conversation_id, None)
+
+    def __len__(self) -> int:
+        return len(self._conversations)
+
+
+class SQLiteHistoryStore:
+    """Same as InMemoryHistoryStore, in a SQLite file so history survives restarts
+    and is shared by the worker processes of one host."""
+
+    def __init__(self, path: str = chat_history_db):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.path = path
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        with self._lock, self._connection:
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute("""CREATE TABLE IF NOT EXISTS history_turns (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                conversation_id TEXT NOT NULL,
+                question TEXT NOT NULL,
+                answer TEXT NOT NULL,
+                created_at REAL NOT NULL)""")
+            self._connection.execute("CREATE INDEX IF NOT EXISTS history_turns_conversation ON history_turns (conversation_id, id)")
+            self._connection.execute("""CREATE TABLE IF NOT EXISTS history_summaries (
+                conversation_id TEXT PRIMARY KEY,
+                summary TEXT NOT NULL,
+                updated_at REAL NOT NULL)""")
+
+    def load(self, conversation_id: str) -> Tuple[str, List[Turn]]:
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT summary FROM history_summaries WHERE conversation_id = ?", (conversation_id,)
+            ).fetchone()
+            turns = self._connection.execute(
+                "SELECT question, answer FROM history_turns WHERE conversation_id = ? ORDER BY id", (conversation_id,)
+            ).fetchall()
+        return (row[0] if row else ""), [tuple(turn) for turn in turns]
+
+    def append(self, conversation_id: str, question: str, answer: str):
+        with self._lock, self._connection:
+            self._connection.execute(
+                "INSERT INTO history_turns (conversation_id, question, answer, created_at) VALUES (?, ?, ?, ?)",
+                (conversation_id, question, answer, time.time())
+            )
+
+    def compact(self, conversation_id: str, summary: str, drop: int):
+        with self._lock, self._connection:
+            self._connection.execute(
+                """DELETE FROM history_turns WHERE id IN (
+                    SELECT id FROM history_turns WHERE conversation_id = ? ORDER BY id LIMIT ?)""",
+                (conversation_id, drop)
+            )
+            self._connection.execute(
+                """INSERT INTO history_summaries (conversation_id, summary, updated_at) VALUES (?, ?, ?)
+                ON CONFLICT(conversation_id) DO UPDATE SET summary = excluded.summary, updated_at = excluded.updated_at""",
+                (conversation_id, summary, time.time())
+            )
+
+    def clear(self, conversation_id: str):
+        with self._lock, self._connection:
+            self._connection.execute("DELETE FROM history_turns WHERE conversation_id = ?", (conversation_id,))
+            self._connection.execute("DELETE FROM history_summaries WHERE conversation_id = ?", (conversation_id,))
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._connection.execute("SELECT COUNT(DISTINCT conversation_id) FROM history_turns").fetchone()[0]
+
+
+def make_history_store(backend: str = chat_history_backend):
+    if backend == "sqlite":
+        return SQLiteHistoryStore()
+    if backend != "memory":
+        logger.warning(f"Unknown CHAT_HISTORY_BACKEND {backend}, using memory")
+    return InMemoryHistoryStore()
+
+
+def format_turn(question: str, answer: str) -> str:
+    return f"user: {question}\nassistant: {answer}\n"
+
+
+def summarize_turns(summary: str, turns: List[Turn], max_tokens: int = chat_history_summary_tokens) -> str:
+    llm = get_llm_chain(
+        llm_name= summary_llm_name,
+        ollama_base_url= ollama_base_url,
+        template= templates["summarize_history"]
+    )
+    return llm.invoke({
+        "summary": summary or "(none)",
+        "messages": "".join(format_turn(question, answer) for question, answer in turns),
+        "max_words": max(20, max_tokens * 3 // 4)
+    }).strip()
+
+
+class ChatHistory:
+    """Bounded chat history of every conversation, keyed by conversation_id.
+
+    The prompt gets the rolling summary plus the newest turns that fit in
+    token_budget, so its size stays the same however long the conversation
+    gets. Turns that fall out of the window are folded into the summary
+    (with summarize on) or dropped. Updates of one conversation are
+    serialized, different conversations don't wait on each other.
+    """
+
+    def __init__(self, store, token_budget: int = chat_history_tokens, summarize: bool = chat_history_summarize,
+                 summary_tokens: int = chat_history_summary_tokens, summarizer= summarize_turns):
+        self.store = store
+        self.token_budget = token_budget
+        self.summarize = summarize
+        self.summary_tokens = summary_tokens
+        self.summarizer = summarizer
+        self._locks = [threading.Lock() for _ in range(64)]
+
+    def _lock(self, conversation_id: str) -> threading.Lock:
+        return self._locks[hash(conversation_id) % len(self._locks)]
+
+    def _clip_summary(self, summary: str) -> str:
+        # The summary has its own budget, a long-winded model can't push the turns out
+        max_chars = self.summary_tokens * 4
+        return summary if len(summary) <= max_chars else summary[-max_chars:]
+
+    def window(self, summary: str, turns: List[Turn]) -> int:
+        """How many of the newest turns fit in the budget left after the summary."""
+        budget = self.token_budget - count_tokens(summary)
+        kept = 0
+        for question, answer in reversed(turns):
+            budget -= count_tokens(format_turn(question, answer))
+            if budget < 0:
+                break
+            kept += 1
+        return kept
+
+    def render(self, conversation_id: str) -> str:
+        """The chat_history prompt input of a conversation, "" for a new one."""
+        summary, turns = self.store.load(conversation_id)
+        kept = self.window(summary, turns)
+        text = f"summary of the earlier conversation: {summary}\n" if summary else ""
+        return text + "".join(format_turn(question, answer) for question, answer in turns[len(turns) - kept:])
+
+    def append(self, conversation_id: str, question: str, answer: str):
+        with self._lock(conversation_id):
+            self.store.append(conversation_id, question, answer)
+            summary, turns = self.store.load(conversation_id)
+            drop = len(turns) - self.window(summary, turns)
+            if drop <= 0:
+                return
+            if self.summarize:
+                try:
+                    summary = self._clip_summary(self.summarizer(summary, turns[:drop], self.summary_tokens))
+                except Exception as e:
+                    logger.info(f"Failed to summarize chat history of {conversation_id}: {e}")
+            self.store.compact(conversation_id, summary, drop)
+
+    def clear(self, conversation_id: str):
+        with self._lock(conversation_id):
+            self.store.clear(conversation_id)
+
+
+conversation_history = ChatHistory(make_history_store())
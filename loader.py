@@ -1,15 +1,22 @@
 import os
+import time
+import argparse
+from itertools import islice
 from typing import List, Dict, Any
 from dotenv import load_dotenv
 
 
-from langchain_neo4j import Neo4jGraph
-from langchain_core.prompts import PromptTemplate
-from langchain_core.output_parsers import StrOutputParser, JsonOutputParser
 # from streamlit.logger import get_logger
 from base_logger import logger
 
-from utils import initialize_smth, read_pdf, extract_from_text
+from utils import initialize_smth, iter_pdf_pages, iter_chunks, extract_from_chunks, extraction_mode, structured_output
+from cache import extraction_cache
+from manifest import RunManifest, run_manifest, file_hash
+from graph import get_graph, bump_graph_version
+from name_index import theorem_index
+from chains import warm_up_models
+from run_report import run_report
+from embeddings import vector_index_queries, embed_theorems, embed_examples, backfill_embeddings
 
 from theorem import Theorem
 from example import Example
@@ -20,18 +27,30 @@ neo4j_username = os.getenv("NEO4J_USERNAME")
 neo4j_password = os.getenv("NEO4J_PASSWORD")
 ollama_base_url = os.getenv("OLLAMA_BASE_URL")
 llm_name = os.getenv("LLM")
+neo4j_batch_size = int(os.getenv("NEO4J_BATCH_SIZE", "500"))
+ingest_checkpoint_chunks = int(os.getenv("INGEST_CHECKPOINT_CHUNKS", "20"))
+embed_at_ingest = os.getenv("EMBED_AT_INGEST", "0") == "1"
 
-#loading neo4j
-neo4j_graph = Neo4jGraph(
-    url=neo4j_url, username=neo4j_username, password=neo4j_password,refresh_schema= False
-)
-initialize_smth(neo4j_graph)
-logger.info("Successfully connected to Neo4j")
+_schema_initialized = False
 
 
+def get_neo4j_graph():
+    # Connect and create the constraints/indexes the first time a write needs them
+    global _schema_initialized
+    neo4j_graph = get_graph()
+    if not _schema_initialized:
+        initialize_smth(neo4j_graph)
+        for query in vector_index_queries():
+            try:
+                neo4j_graph.query(query)
+            except Exception as e:
+                logger.info(f"Vector index already exists or error: {e}")
+        _schema_initialized = True
+        logger.info("Successfully connected to Neo4j")
+    return neo4j_graph
 
 
-def add_theorem(theorem:Theorem):
+def add_theorem(theorem:Theorem, link_dependencies: bool = True):
     try:
         create_theorem_query = """
         MERGE (t:Theorem {name: $name})
@@ -49,7 +68,7 @@ def add_theorem(theorem:Theorem):
                 
                 RETURN t.name as name
         """#hound dog(tf)(time)
-        neo4j_graph.query(
+        get_neo4j_graph().query(
             create_theorem_query,
             params={
                 'name': theorem.name,
@@ -61,20 +80,11 @@ def add_theorem(theorem:Theorem):
             }
         )
 
-        for dep_name in theorem.dependencies:
-            if dep_name.strip():
-                dep_query = """
-                MATCH (t:Theorem {name: $theorem_name})
-                MERGE (d:Theorem {name: $dep_name})
-                MERGE (t)-[:DEPENDS_ON]->(d)
-                """
-                neo4j_graph.query(
-                    dep_query,
-                    params={
-                        'theorem_name': theorem.name,
-                        'dep_name': dep_name.strip()
-                    }
-                )
+        theorem_index.add([theorem.name])
+
+        if link_dependencies:
+            resolve_links(dependency_rows= dependency_rows([theorem]))
+        bump_graph_version(get_neo4j_graph())
 
         logger.info(f"Added: {theorem.name}")
         return True
@@ -83,14 +93,10 @@ def add_theorem(theorem:Theorem):
         return False    
 
 def check_theorem_existence(theorem_name: str) -> bool:
-    query = """
-    MATCH (t:Theorem {name: $name})
-    RETURN count(t) > 0 as exists
-    """
-    result = neo4j_graph.query(query, params={'name': theorem_name})
-    return result[0]['exists'] if result else False
+    theorem_index.ensure_loaded(get_neo4j_graph())
+    return theorem_name in theorem_index
 
-def add_example(example: Example) -> bool:
+def add_example(example: Example, link_theorems: bool = True) -> bool:
         try:
             create_example_query = """
             MERGE (e:Example {name: $name})
@@ -108,7 +114,7 @@ def add_example(example: Example) -> bool:
             RETURN e.name as name
             """
             
-            neo4j_graph.query(
+            get_neo4j_graph().query(
                 create_example_query,
                 params={
                 'name': example.name,
@@ -118,22 +124,9 @@ def add_example(example: Example) -> bool:
                 'domain': example.domain
             })
             
-            for theorem_name in example.illustrates_theorems:
-                if theorem_name and theorem_name.strip():
-                    if check_theorem_existence(theorem_name= theorem_name):#mh
-                        illustrates_query = """
-                        MATCH (e:Example {name: $example_name})
-                        MERGE (t:Theorem {name: $theorem_name})
-                        MERGE (e)-[:ILLUSTRATES]->(t)
-                        """
-                        neo4j_graph.query(
-                            illustrates_query,
-                            params={
-                            'example_name': example.name,
-                            'theorem_name': theorem_name.strip()
-                        })
-                    else:
-                        logger.info(f"Couldn't find: {theorem_name}")
+            if link_theorems:
+                resolve_links(illustrates_rows= illustrates_rows([example]))
+            bump_graph_version(get_neo4j_graph())
             
             logger.info(f"Added example: {example.name}")
             return True
@@ -142,44 +135,292 @@ def add_example(example: Example) -> bool:
             return False
 
 
-def process_file(file_path:str):
-    text = read_pdf(file_path, logger=logger)
-    theorems, examples = extract_from_text(
-        extract= {"example"},#"theorem", "example"
-        text= text,
-        logger= logger
-    )
-    
+def batched(items: list, batch_size: int):
+    for i in range(0, len(items), max(1, batch_size)):
+        yield items[i:i + max(1, batch_size)]
+
+
+def dependency_rows(theorems: List[Theorem]) -> List[Dict[str, str]]:
+    return [
+        {'theorem_name': theorem.name, 'dep_name': dep_name.strip()}
+        for theorem in theorems for dep_name in theorem.dependencies if dep_name.strip()
+    ]
+
+
+def illustrates_rows(examples: List[Example]) -> List[Dict[str, str]]:
+    return [
+        {'example_name': example.name, 'theorem_name': theorem_name.strip()}
+        for example in examples for theorem_name in example.illustrates_theorems
+        if theorem_name and theorem_name.strip()
+    ]
+
+
+def resolve_links(dependency_rows: List[Dict[str, str]] = (), illustrates_rows: List[Dict[str, str]] = (), batch_size: int = neo4j_batch_size):
+    """Create DEPENDS_ON/ILLUSTRATES links whose target theorem is known.
+
+    Targets are checked against the in-memory theorem index, never MERGEd, so
+    no stub theorems get created. Rows whose target isn't in the graph yet
+    are returned as (dependency_rows, illustrates_rows) to retry later.
+    """
+    neo4j_graph = get_neo4j_graph()
+    theorem_index.ensure_loaded(neo4j_graph)
+
+    link_queries = [
+        (dependency_rows, 'dep_name', """
+        UNWIND $rows AS row
+        MATCH (t:Theorem {name: row.theorem_name})
+        MATCH (d:Theorem {name: row.dep_name})
+        MERGE (t)-[:DEPENDS_ON]->(d)
+        """),
+        (illustrates_rows, 'theorem_name', """
+        UNWIND $rows AS row
+        MATCH (e:Example {name: row.example_name})
+        MATCH (t:Theorem {name: row.theorem_name})
+        MERGE (e)-[:ILLUSTRATES]->(t)
+        """),
+    ]
+    unresolved = []
+    for rows, target, query in link_queries:
+        found = [row for row in rows if row[target] in theorem_index]
+        missing = [row for row in rows if row[target] not in theorem_index]
+        for batch in batched(found, batch_size):
+            neo4j_graph.query(query, params={'rows': batch})
+        if found:
+            bump_graph_version(neo4j_graph)
+        if missing:
+            targets = sorted({row[target] for row in missing})
+            logger.info(f"Couldn't find {len(targets)} link target(s): {', '.join(targets[:10])}" + (", ..." if len(targets) > 10 else ""))
+        unresolved.append(missing)
+    return unresolved[0], unresolved[1]
+
+
+def add_theorems(theorems: List[Theorem], batch_size: int = neo4j_batch_size, link_dependencies: bool = True):
+    """Write theorems with one UNWIND query per batch (plus one for their dependencies).
+
+    A batch that fails is retried row by row with add_theorem so the
+    counts still say exactly which theorems made it in.
+    Returns (successful_count, failed_count).
+    """
     successful_count = 0
-    failed_count = 0 
-    
-    for theorem in theorems:
-        if add_theorem(theorem):
-            successful_count += 1
-        else:
-            failed_count += 1
-    
-    logger.info(f"Successfully added {successful_count} theorem(s)")
-    logger.info(f"Failed to added {failed_count} theorem(s)")
+    failed_count = 0
+    for batch in batched(theorems, batch_size):
+        try:
+            create_theorems_query = """
+            UNWIND $rows AS row
+            MERGE (t:Theorem {name: row.name})
+                SET t.statement = row.statement,
+                    t.proof = row.proof,
+                    t.type = row.type
+
+            MERGE (s:Subject {name: row.subject})
+            MERGE (t)-[:BELONGS_TO_SUBJECT]->(s)
+
+            MERGE (d:Domain {name: row.domain})
+            MERGE (t)-[:BELONGS_TO_DOMAIN]->(d)
+            MERGE (d)-[:PART_OF_SUBJECT]->(s)
+            """
+            get_neo4j_graph().query(
+                create_theorems_query,
+                params={'rows': [
+                    {
+                        'name': theorem.name,
+                        'statement': theorem.statement,
+                        'proof': theorem.proof,
+                        'type': theorem.type,
+                        'subject': theorem.subject,
+                        'domain': theorem.domain
+                    } for theorem in batch
+                ]}
+            )
 
+            theorem_index.add(theorem.name for theorem in batch)
+            if link_dependencies:
+                resolve_links(dependency_rows= dependency_rows(batch), batch_size= batch_size)
+            bump_graph_version(get_neo4j_graph())
+
+            successful_count += len(batch)
+            logger.info(f"Added batch of {len(batch)} theorem(s)")
+        except Exception as e:
+            logger.info(f"Batch of {len(batch)} theorem(s) failed, retrying one by one: {e}")
+            for theorem in batch:
+                if add_theorem(theorem, link_dependencies= link_dependencies):
+                    successful_count += 1
+                else:
+                    failed_count += 1
+    return successful_count, failed_count
+
+
+def add_examples(examples: List[Example], batch_size: int = neo4j_batch_size, link_theorems: bool = True):
+    """Write examples and their ILLUSTRATES links with UNWIND queries per batch.
+
+    Links are only created to theorems already in the graph, same as add_example;
+    with link_theorems=False they are left to a later resolve_links pass.
+    Returns (successful_count, failed_count).
+    """
     successful_count = 0
     failed_count = 0
+    for batch in batched(examples, batch_size):
+        try:
+            create_examples_query = """
+            UNWIND $rows AS row
+            MERGE (e:Example {name: row.name})
+            SET e.content = row.content,
+                e.difficulty = row.difficulty
+
+            MERGE (s:Subject {name: row.subject})
+            MERGE (e)-[:BELONGS_TO_SUBJECT]->(s)
+
+            MERGE (d:Domain {name: row.domain})
+            MERGE (e)-[:BELONGS_TO_DOMAIN]->(d)
+            MERGE (d)-[:PART_OF_SUBJECT]->(s)
+            """
+            get_neo4j_graph().query(
+                create_examples_query,
+                params={'rows': [
+                    {
+                        'name': example.name,
+                        'content': example.content,
+                        'difficulty': example.difficulty,
+                        'subject': example.subject,
+                        'domain': example.domain
+                    } for example in batch
+                ]}
+            )
+
+            if link_theorems:
+                resolve_links(illustrates_rows= illustrates_rows(batch), batch_size= batch_size)
+            bump_graph_version(get_neo4j_graph())
+
+            successful_count += len(batch)
+            logger.info(f"Added batch of {len(batch)} example(s)")
+        except Exception as e:
+            logger.error(f"Batch of {len(batch)} example(s) failed, retrying one by one: {e}")
+            for example in batch:
+                if add_example(example, link_theorems= link_theorems):
+                    successful_count += 1
+                else:
+                    failed_count += 1
+    return successful_count, failed_count
+
+
+def process_file(file_path:str, extract= {"example"}, manifest: RunManifest = run_manifest, checkpoint_chunks: int = ingest_checkpoint_chunks, mode: str = extraction_mode,
+                 structured: bool = structured_output, ollama_base_url: str = ollama_base_url):#"theorem", "example"
+    if manifest.find_finished(file_path, extract, mode):
+        logger.info(f"Already ingested, skipping: {file_path}")
+        run_report.record("file", file= file_path, skipped= True)
+        return
+
+    key = RunManifest.make_key(file_hash(file_path), extract, mode)
+    if manifest.is_done(key):
+        manifest.commit(key, file_path, manifest.last_chunk(key), done= True)
+        logger.info(f"Already ingested, skipping: {file_path}")
+        run_report.record("file", file= file_path, skipped= True)
+        return
+    file_started = time.perf_counter()
+
+    chunks = iter_chunks(iter_pdf_pages(file_path, logger= logger))
+
+    start = manifest.last_chunk(key)
+    if start:
+        logger.info(f"Resuming from chunk {start + 1}")
+        # Splitting is deterministic, so the first chunks are re-split and dropped, not re-extracted
+        chunks = islice(chunks, start, None)
+
+    theorem_counts = [0, 0]
+    example_counts = [0, 0]
+    window_start = start
+    # Each window is extracted and written before the manifest moves forward,
+    # so a crash loses at most one window of work.
+    def stop(error: str):
+        # The manifest keeps the last committed window, the next run resumes the file from there
+        logger.error(f"Stopped {file_path} after {window_start} chunks, left resumable: {error}")
+        run_report.record("file", file= file_path, chunks= window_start, resumed_from= start, error= error,
+                          seconds= round(time.perf_counter() - file_started, 3))
+
+    while True:
+        try:
+            window = list(islice(chunks, max(1, checkpoint_chunks)))
+        except Exception as e:
+            stop(f"{type(e).__name__}: {e}")
+            return
+        if not window:
+            break
+        failed_chunks = []
+        theorems, examples = extract_from_chunks(
+            extract= extract,
+            chunks= window,
+            logger= logger,
+            start= window_start,
+            mode= mode,
+            source= file_path,
+            structured= structured,
+            ollama_base_url= ollama_base_url,
+            failed_chunks= failed_chunks
+        )
+        if failed_chunks:
+            stop(f"LLM call failed for chunk(s) {sorted(failed_chunks)}")
+            return
+        theorems = list({t.name: t for t in theorems}.values())
+        examples = list({e.name: e for e in examples}.values())
+        chunk_range = [window_start + 1, window_start + len(window)]
+
+        for kind, rows, add, counts in (("theorem", theorems, add_theorems, theorem_counts), ("example", examples, add_examples, example_counts)):
+            started = time.perf_counter()
+            successful_count, failed_count = add(rows, **{"link_dependencies" if kind == "theorem" else "link_theorems": False})
+            run_report.record("write", file= file_path, chunks= chunk_range, kind= kind, rows= len(rows),
+                              succeeded= successful_count, failed= failed_count, seconds= round(time.perf_counter() - started, 3))
+            counts[0] += successful_count
+            counts[1] += failed_count
+            if failed_count:
+                # Rows already written are MERGEd again when the window is redone
+                stop(f"{failed_count} {kind} write(s) failed in chunks {chunk_range[0]}-{chunk_range[1]}")
+                return
+
+        if embed_at_ingest:
+            # A failed embedding batch is left for --backfill-embeddings, the nodes are already written
+            started = time.perf_counter()
+            try:
+                embedded = embed_theorems(theorems) + embed_examples(examples)
+                logger.info(f"Embedded {embedded} theorem/example statement(s)")
+            except Exception as e:
+                embedded = 0
+                logger.info(f"Failed to embed window: {e}")
+            run_report.record("embed", file= file_path, chunks= chunk_range, rows= embedded, seconds= round(time.perf_counter() - started, 3))
+
+        # Links wait until the whole file is in, a dependency often shows up chunks later
+        manifest.add_pending_links(dependency_rows(theorems), illustrates_rows(examples))
+        window_start += len(window)
+        manifest.commit(key, file_path, window_start)
+        logger.info(f"Checkpoint: {window_start} chunks committed")
+
+    started = time.perf_counter()
+    pending = len(manifest.pending_links["dependency_rows"]) + len(manifest.pending_links["illustrates_rows"])
+    dependency_left, illustrates_left = resolve_links(**manifest.pending_links)
+    logger.info(f"Linked pending dependencies/examples, {len(dependency_left)} dependency and {len(illustrates_left)} example link(s) still unresolved")
+    dropped = manifest.retry_pending_links(dependency_left, illustrates_left)
+    if dropped:
+        logger.info(f"Gave up on {dropped} link(s) that stayed unresolved")
+    run_report.record("links", file= file_path, pending= pending, unresolved= len(dependency_left) + len(illustrates_left),
+                      unresolved_dependencies= len(dependency_left), unresolved_examples= len(illustrates_left), dropped= dropped,
+                      seconds= round(time.perf_counter() - started, 3))
+    manifest.commit(key, file_path, window_start, total_chunks= window_start, done= True)
     
-    for example in examples:
-        if add_example(example):
-            successful_count += 1
-        else:
-            failed_count += 1
+    logger.info(f"Successfully added {theorem_counts[0]} theorem(s)")
+    logger.info(f"Failed to added {theorem_counts[1]} theorem(s)")
 
-    logger.info(f"Successfully added {successful_count} example(s)")
-    logger.info(f"Failed to added {failed_count} example(s)")
+    logger.info(f"Successfully added {example_counts[0]} example(s)")
+    logger.info(f"Failed to added {example_counts[1]} example(s)")
 
+    run_report.record("file", file= file_path, chunks= window_start, resumed_from= start,
+                      theorems_written= theorem_counts[0], theorems_failed= theorem_counts[1],
+                      examples_written= example_counts[0], examples_failed= example_counts[1],
+                      seconds= round(time.perf_counter() - file_started, 3))
     logger.info(f"Finished processing.")
     logger.info("=" * 80)
 
 
 
-def load_input(input_path = "input/"):
+def load_input(input_path = "input/", mode: str = extraction_mode, structured: bool = structured_output):
     if not os.path.exists(input_path):
         logger.info("couldn't find input path")
     
@@ -188,6 +429,51 @@ def load_input(input_path = "input/"):
             logger.info("=" * 80)
             logger.info(f"Processing: {file}")
             pdf_file_path = os.path.join(input_path, file)
-            process_file(pdf_file_path)
+            process_file(pdf_file_path, mode= mode, structured= structured)
+
+def main(argv= None):
+    parser = argparse.ArgumentParser(description="Extract theorems and examples from PDFs into neo4j")
+    parser.add_argument("--input", default="input/", help="folder with the PDFs to ingest")
+    parser.add_argument("--mode", choices=["separate", "combined"], default=extraction_mode, help="one LLM call per kind, or theorems and examples in a single call")
+    parser.add_argument("--structured", action=argparse.BooleanOptionalAction, default=structured_output,
+                        help="constrain LLM output to the Theorem/Example JSON schema and repair chunks that fail validation")
+    parser.add_argument("--no-cache", action="store_true", help="always call the LLM, don't read or write the extraction cache")
+    parser.add_argument("--clear-cache", action="store_true", help="empty the extraction cache before running")
+    parser.add_argument("--restart", action="store_true", help="forget previous progress and ingest every file from the start")
+    parser.add_argument("--backfill-embeddings", action="store_true", help="embed the theorems/examples that have no embedding yet, then exit")
+    parser.add_argument("--report", default=None, help="JSONL run report path (default INGEST_REPORT_DIR/ingest-<time>.jsonl), summarize it with run_report.py")
+    parser.add_argument("--no-report", action="store_true", help="don't write a run report")
+    args = parser.parse_args(argv)
+
+    if args.backfill_embeddings:
+        get_neo4j_graph()
+        totals = backfill_embeddings()
+        logger.info(f"Backfilled embeddings: {totals}")
+        return
+
+    if args.restart:
+        run_manifest.clear()
+
+    if args.clear_cache:
+        extraction_cache.clear()
+    if args.no_cache:
+        extraction_cache.enabled = False
+
+    if not args.no_report:
+        report_path = run_report.open(args.report)
+        logger.info(f"Writing run report to {report_path}")
+        run_report.record("run_start", input= args.input, mode= args.mode, structured= args.structured, llm= llm_name, cache= extraction_cache.enabled,
+                          checkpoint_chunks= ingest_checkpoint_chunks)
+    started = time.perf_counter()
+    try:
+        if os.getenv("OLLAMA_WARM_UP", "1") == "1":
+            warm_up_models([llm_name], ollama_base_url)
+        load_input(args.input, mode= args.mode, structured= args.structured)
+    finally:
+        run_report.record("run_end", seconds= round(time.perf_counter() - started, 3),
+                          cache_hits= extraction_cache.hits, cache_misses= extraction_cache.misses)
+        run_report.close()
+
 
-load_input()
\ No newline at end of file
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,140 @@
+import os
+import json
+import time
+import hashlib
+import threading
+from dotenv import load_dotenv
+
+from base_logger import logger
+
+load_dotenv(".env")
+
+ingest_manifest_path = os.getenv("INGEST_MANIFEST", ".cache/ingest_manifest.json")
+# Unresolved links are retried after this many files at most, and only the newest PENDING_LINKS_MAX are kept
+pending_link_attempts = int(os.getenv("PENDING_LINK_ATTEMPTS", "3"))
+pending_links_max = int(os.getenv("PENDING_LINKS_MAX", "20000"))
+
+
+def file_hash(file_path: str) -> str:
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class RunManifest:
+    """Progress of every ingested file, saved to disk after each checkpoint.
+
+    Entries are keyed by the file content hash plus what was extracted, so a
+    renamed file is still recognised and an edited one starts over. Each entry
+    keeps the number of chunks already written to neo4j and whether the file
+    is finished. DEPENDS_ON/ILLUSTRATES rows that couldn't be linked yet are
+    kept as well, so they survive restarts and get retried after each file.
+    """
+
+    def __init__(self, path: str = ingest_manifest_path):
+        self.path = path
+        self._lock = threading.Lock()
+        data = self._load()
+        self.entries = data.get("files", {})
+        self.pending_links = data.get("pending_links", {"dependency_rows": [], "illustrates_rows": []})
+
+    def _load(self) -> dict:
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError) as e:
+            logger.warning(f"Couldn't read ingest manifest, starting a new one: {e}")
+            return {}
+
+    def _save(self):
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"files": self.entries, "pending_links": self.pending_links}, f, indent=2)
+        os.replace(tmp_path, self.path)
+
+    @staticmethod
+    def make_key(content_hash: str, extract, mode: str = "separate") -> str:
+        return f"{content_hash}:{'+'.join(sorted(extract))}:{mode}"
+
+    def find_finished(self, file_path: str, extract, mode: str = "separate"):
+        # Cheap check on path/size/mtime so finished files are skipped without hashing them
+        stat = os.stat(file_path)
+        kinds = f"{'+'.join(sorted(extract))}:{mode}"
+        for key, entry in self.entries.items():
+            if (entry.get("done") and key.endswith(":" + kinds) and entry.get("path") == file_path
+                    and entry.get("size") == stat.st_size and entry.get("mtime") == stat.st_mtime):
+                return key
+        return None
+
+    def get(self, key: str) -> dict:
+        return self.entries.get(key, {})
+
+    def last_chunk(self, key: str) -> int:
+        return self.get(key).get("last_chunk", 0)
+
+    def is_done(self, key: str) -> bool:
+        return self.get(key).get("done", False)
+
+    def commit(self, key: str, file_path: str, last_chunk: int, total_chunks: int = None, done: bool = False):
+        stat = os.stat(file_path)
+        with self._lock:
+            entry = self.entries.setdefault(key, {})
+            entry.update({
+                "path": file_path,
+                "size": stat.st_size,
+                "mtime": stat.st_mtime,
+                "last_chunk": last_chunk,
+                "done": done,
+                "updated_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            })
+            if total_chunks is not None:
+                entry["total_chunks"] = total_chunks
+            self._save()
+
+    def add_pending_links(self, dependency_rows, illustrates_rows):
+        # Saved with the next commit so links and the chunk index move together
+        with self._lock:
+            self.pending_links["dependency_rows"].extend(dependency_rows)
+            self.pending_links["illustrates_rows"].extend(illustrates_rows)
+
+    def set_pending_links(self, dependency_rows, illustrates_rows):
+        with self._lock:
+            self.pending_links = {"dependency_rows": list(dependency_rows), "illustrates_rows": list(illustrates_rows)}
+
+    def retry_pending_links(self, dependency_rows, illustrates_rows, max_attempts: int = pending_link_attempts,
+                            max_rows: int = pending_links_max) -> int:
+        """Keep rows that are still unresolved for another attempt, returns how many were dropped.
+
+        A row is dropped once it has been tried max_attempts times (its target
+        most likely isn't a theorem of any book), duplicates are kept once and
+        each list holds at most max_rows, the newest ones.
+        """
+        kept, dropped = {}, 0
+        for name, rows in (("dependency_rows", dependency_rows), ("illustrates_rows", illustrates_rows)):
+            unique = {}
+            for row in rows:
+                key = tuple(sorted((field, value) for field, value in row.items() if field != "attempts"))
+                attempts = row.get("attempts", 0) + 1
+                if key not in unique or attempts > unique[key]["attempts"]:
+                    unique[key] = dict(row, attempts= attempts)
+            retry = [row for row in unique.values() if row["attempts"] < max_attempts][-max_rows:]
+            dropped += len(unique) - len(retry)
+            kept[name] = retry
+        self.set_pending_links(kept["dependency_rows"], kept["illustrates_rows"])
+        return dropped
+
+    def clear(self):
+        with self._lock:
+            self.entries = {}
+            self.pending_links = {"dependency_rows": [], "illustrates_rows": []}
+            self._save()
+
+
+run_manifest = RunManifest()
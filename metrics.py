@@ -0,0 +1,203 @@
+import time
+import threading
+from bisect import bisect_left
+from contextlib import contextmanager
+from typing import Callable, Dict, List, Tuple
+
+SECONDS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+TOKEN_BUCKETS = (16, 32, 64, 128, 256, 512, 1024, 2048, 4096, 8192)
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(labels: Dict[str, str]) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{_escape(value)}"' for key, value in labels.items()) + "}"
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    if isinstance(value, int) or float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+class Metric:
+    """A metric family with fixed label names; samples are kept per label values."""
+
+    type = "untyped"
+
+    def __init__(self, name: str, help: str, labelnames: Tuple[str, ...] = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels: Dict[str, str]) -> tuple:
+        return tuple(str(labels.get(name, "")) for name in self.labelnames)
+
+    def _labels(self, key: tuple) -> Dict[str, str]:
+        return dict(zip(self.labelnames, key))
+
+    def samples(self) -> List[Tuple[str, Dict[str, str], float]]:
+        with self._lock:
+            return [(self.name, self._labels(key), value) for key, value in self._values.items()]
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, value: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + value
+
+
+class Gauge(Metric):
+    type = "gauge"
+
+    def set(self, value: float, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def inc(self, value: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + value
+
+    def dec(self, value: float = 1, **labels):
+        self.inc(-value, **labels)
+
+    @contextmanager
+    def track(self, **labels):
+        self.inc(**labels)
+        try:
+            yield
+        finally:
+            self.dec(**labels)
+
+
+class Histogram(Metric):
+    """Fixed-bucket histogram; observe() is a bisect and two additions under a lock."""
+
+    type = "histogram"
+
+    def __init__(self, name: str, help: str, labelnames: Tuple[str, ...] = (), buckets=SECONDS_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            entry[0][index] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def samples(self):
+        with self._lock:
+            values = [(key, list(counts), total, count) for key, (counts, total, count) in self._values.items()]
+        samples = []
+        for key, counts, total, count in values:
+            labels = self._labels(key)
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += bucket_count
+                samples.append((f"{self.name}_bucket", dict(labels, le=_format_value(bound)), cumulative))
+            samples.append((f"{self.name}_sum", labels, total))
+            samples.append((f"{self.name}_count", labels, count))
+        return samples
+
+
+class Registry:
+    """Metrics rendered in the Prometheus text format.
+
+    Collectors are called at scrape time and return metrics built from
+    state kept elsewhere (cache counters), so nothing is updated twice.
+    """
+
+    def __init__(self):
+        self.metrics = []
+        self.collectors = {}
+
+    def register(self, metric: Metric) -> Metric:
+        self.metrics.append(metric)
+        return metric
+
+    def collector(self, name: str, collect: Callable[[], List[Metric]]):
+        # Registering a name again replaces it, the async server overrides the Flask one it imports
+        self.collectors[name] = collect
+        return collect
+
+    def render(self) -> str:
+        metrics = list(self.metrics)
+        for collect in self.collectors.values():
+            metrics.extend(collect())
+        lines = []
+        for metric in metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            for name, labels, value in metric.samples():
+                lines.append(f"{name}{_format_labels(labels)} {_format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+request_seconds = registry.register(Histogram(
+    "chat_request_seconds", "Time to answer a chat request, until the last token for streams", ("endpoint",)))
+requests_total = registry.register(Counter(
+    "chat_requests_total", "Chat requests by endpoint and outcome", ("endpoint", "status")))
+requests_in_progress = registry.register(Gauge(
+    "chat_requests_in_progress", "Chat requests being answered", ("endpoint",)))
+stage_seconds = registry.register(Histogram(
+    "chat_stage_seconds", "Time spent in each generate_respond stage", ("stage",)))
+time_to_first_token = registry.register(Histogram(
+    "chat_time_to_first_token_seconds", "Time from the request to the first answer token (whole answer for /chat)", ("endpoint",)))
+prompt_tokens = registry.register(Histogram(
+    "chat_prompt_tokens", "Tokens in the answer prompt", ("template",), buckets=TOKEN_BUCKETS))
+completion_tokens = registry.register(Histogram(
+    "chat_completion_tokens", "Tokens in the generated answer", ("template",), buckets=TOKEN_BUCKETS))
+
+
+def cache_metrics(caches: Dict[str, object]) -> List[Metric]:
+    """Hit/miss counters and hit ratio of caches with a stats() method (VersionedLRUCache)."""
+    hits = Counter("chat_cache_hits_total", "Cache hits", ("cache",))
+    misses = Counter("chat_cache_misses_total", "Cache misses", ("cache",))
+    ratio = Gauge("chat_cache_hit_ratio", "Cache hits over lookups since start", ("cache",))
+    size = Gauge("chat_cache_entries", "Entries in the cache", ("cache",))
+    for name, cache in caches.items():
+        stats = cache.stats()
+        hits.inc(stats["hits"], cache=name)
+        misses.inc(stats["misses"], cache=name)
+        ratio.set(stats["hit_rate"], cache=name)
+        size.set(stats["size"], cache=name)
+    return [hits, misses, ratio, size]
+
+
+def flight_metrics(in_flight) -> List[Metric]:
+    stats = in_flight.stats()
+    flights = Gauge("chat_coalesced_flights_in_progress", "Generations shared by identical in-flight requests")
+    flights.set(stats["in_flight"])
+    joined = Counter("chat_coalesced_requests_total", "Requests by whether they led or joined a generation", ("role",))
+    joined.inc(stats["leaders"], role="leader")
+    joined.inc(stats["followers"], role="follower")
+    return [flights, joined]
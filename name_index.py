@@ -0,0 +1,139 @@
+import re
+import threading
+from collections import defaultdict
+from typing import Iterable, List, Optional, Tuple
+
+from base_logger import logger
+
+THEOREM_NAMES_QUERY = """
+MATCH (t:Theorem)
+WHERE t.statement IS NOT NULL
+RETURN t.name AS name
+"""
+
+
+class TheoremNameIndex:
+    """Names of the theorems in the graph, kept in memory.
+
+    Loaded once from neo4j and updated by the loader as it writes, so
+    "does this theorem exist" is a set lookup instead of a query. Stub nodes
+    (created by old runs from dependency names, no statement) are left out.
+    """
+
+    def __init__(self):
+        self.names = set()
+        self.loaded = False
+        self._lock = threading.Lock()
+
+    def load(self, graph):
+        names = {record['name'] for record in graph.query(THEOREM_NAMES_QUERY)}
+        with self._lock:
+            self.names |= names
+            self.loaded = True
+        logger.info(f"Loaded {len(names)} theorem names into the index")
+
+    def ensure_loaded(self, graph):
+        if not self.loaded:
+            self.load(graph)
+
+    def add(self, names: Iterable[str]):
+        with self._lock:
+            self.names.update(name.strip() for name in names if name and name.strip())
+
+    def __contains__(self, name: str) -> bool:
+        return bool(name) and name.strip() in self.names
+
+    def __len__(self) -> int:
+        return len(self.names)
+
+
+theorem_index = TheoremNameIndex()
+
+
+ABBREVIATIONS = {
+    "thm": "theorem", "thms": "theorems", "lem": "lemma", "prop": "proposition",
+    "cor": "corollary", "def": "definition", "eq": "equation",
+}
+STOP_WORDS = {"the", "a", "an", "of", "for", "on"}
+
+
+def normalize_name(name: str) -> str:
+    # Numbers keep their dots, "Theorem 3.4" and "Theorem 4.3" are different theorems
+    words = re.findall(r"[a-z]+|\d+(?:\.\d+)*", name.lower().replace("'s", ""))
+    return " ".join(ABBREVIATIONS.get(word, word) for word in words if word not in STOP_WORDS)
+
+
+def number_tokens(key: str) -> frozenset:
+    return frozenset(word for word in key.split() if word[0].isdigit())
+
+
+def trigrams(text: str) -> set:
+    padded = f"  {text} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+class TrigramNameResolver:
+    """Maps free-form theorem names to the canonical Theorem.name values.
+
+    Names are normalized (case, punctuation, "Thm." -> "theorem", stop words)
+    and indexed by character trigrams; candidates sharing trigrams with the
+    query are ranked by Dice similarity, with a bonus when every query word
+    is part of the name. Numbers must match exactly: "Theorem 4.3" never
+    resolves to "Theorem 11" however many trigrams they share.
+    """
+
+    def __init__(self, names: Iterable[str] = (), cutoff: float = 0.5):
+        self.cutoff = cutoff
+        self.names = []
+        self.normalized = []
+        self.grams = []
+        self.numbers = []
+        self.exact = {}
+        self.postings = defaultdict(list)
+        for name in dict.fromkeys(names):
+            key = normalize_name(name)
+            if not key:
+                continue
+            name_id = len(self.names)
+            self.names.append(name)
+            self.normalized.append(key)
+            self.grams.append(trigrams(key))
+            self.numbers.append(number_tokens(key))
+            self.exact.setdefault(key, name)
+            for gram in self.grams[name_id]:
+                self.postings[gram].append(name_id)
+
+    def resolve(self, name: str, limit: int = 5, cutoff: float = None) -> List[Tuple[str, float]]:
+        """Ranked (canonical name, score) candidates scoring at least cutoff."""
+        cutoff = self.cutoff if cutoff is None else cutoff
+        key = normalize_name(name)
+        if not key:
+            return []
+        if key in self.exact:
+            return [(self.exact[key], 1.0)]
+
+        query_grams = trigrams(key)
+        # Grams shared by a big share of the names ("theorem") only pick candidates when nothing else does
+        common = max(50, len(self.names) // 10)
+        rare = [gram for gram in query_grams if len(self.postings.get(gram, ())) <= common]
+        candidates = set()
+        for gram in rare or query_grams:
+            candidates.update(self.postings.get(gram, ()))
+
+        words = set(key.split())
+        numbers = number_tokens(key)
+        scored = []
+        for name_id in candidates:
+            if self.numbers[name_id] != numbers:
+                continue
+            score = 2 * len(query_grams & self.grams[name_id]) / (len(query_grams) + len(self.grams[name_id]))
+            if words <= set(self.normalized[name_id].split()):
+                score = min(1.0, score + 0.15)
+            if score >= cutoff:
+                scored.append((self.names[name_id], round(score, 3)))
+        scored.sort(key=lambda candidate: -candidate[1])
+        return scored[:limit]
+
+    def best(self, name: str, cutoff: float = None) -> Optional[str]:
+        candidates = self.resolve(name, limit=1, cutoff=cutoff)
+        return candidates[0][0] if candidates else None
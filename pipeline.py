@@ -0,0 +1,102 @@
+"""Chat pipeline steps shared by backend.py (Flask) and async_backend.py (Quart).
+
+Nothing here waits on the network or the database: the servers do their
+own I/O (routing, parsing, retrieval, generation, history) and call these
+for the decisions and bookkeeping in between, so both answer the same way.
+"""
+import os
+import json
+from typing import List, Dict, Any, Optional, Tuple
+from dotenv import load_dotenv
+
+from templates import templates
+from base_logger import logger
+
+from chains import get_llm_chain, count_tokens
+from cache import AnswerCache, normalize_question
+from router import NO_ALGEBRA, refers_back
+from context import pack_prompt, template_tokens
+from metrics import stage_seconds, prompt_tokens, completion_tokens
+
+load_dotenv(".env")
+
+ollama_base_url = os.getenv("OLLAMA_BASE_URL")
+llm_name = os.getenv("CHAT_LLM")
+# Questions that name no theorem ("whatever") get the closest theorems by embedding
+vector_retrieval = os.getenv("VECTOR_RETRIEVAL", "0") == "1"
+
+# Questions that point back to earlier turns ("why does it hold?") are not cached, their answer depends on the conversation
+answer_cache = AnswerCache(
+    max_entries= int(os.getenv("ANSWER_CACHE_SIZE", "512")),
+    ttl= float(os.getenv("ANSWER_CACHE_TTL", "86400")),
+    threshold= float(os.getenv("ANSWER_CACHE_THRESHOLD", "0")) or None
+)
+
+
+def parse_chain():
+    return get_llm_chain(
+        llm_name= llm_name,
+        ollama_base_url= ollama_base_url,
+        template= templates["parse_question"]
+    )
+
+
+def answer_chain(template_name: str):
+    return get_llm_chain(
+        llm_name= llm_name,
+        ollama_base_url= ollama_base_url,
+        template= templates[template_name]
+    )
+
+
+def wants_vector_retrieval(query: str) -> bool:
+    return vector_retrieval and query.strip() == "whatever"
+
+
+def without_rag(query: str, theorems: List[Dict[str, Any]]) -> bool:
+    # Small talk, or nothing named and nothing found by embedding
+    return not theorems and query.strip() in [NO_ALGEBRA, "whatever"]
+
+
+def answer_inputs(template_name: str, theorems: List[Dict[str, Any]], question: str,
+                  chat_history: str) -> Tuple[str, Dict[str, Any], List[Dict[str, Any]]]:
+    """Inputs of the answer template, the theorems packed into the prompt budget.
+
+    Returns (template_name, inputs, theorems) and records the prompt tokens used.
+    """
+    logger.info(f"used {template_name}")
+    inputs = {"chat_history": chat_history, "question": question}
+    if template_name == "answer_without_rag":
+        prompt_tokens.observe(template_tokens(templates[template_name]) + count_tokens(chat_history) + count_tokens(question),
+                              template= template_name)
+        return template_name, inputs, theorems
+    with stage_seconds.time(stage="pack"):
+        inputs["theorems"], report = pack_prompt(templates[template_name], theorems, question, chat_history)
+    prompt_tokens.observe(report["total"], template= template_name)
+    return template_name, inputs, theorems
+
+
+def answer_cache_key(question: str, chat_history: str = "") -> Optional[str]:
+    """Key of the question in answer_cache, None when its answer depends on the conversation."""
+    if chat_history.strip() and refers_back(question):
+        return None
+    return normalize_question(question)
+
+
+def generation_key(question: str, chat_history: str = "") -> tuple:
+    # Only the same question in the same conversation state can share a generation
+    return normalize_question(question), chat_history
+
+
+def finish_answer(template_name: str, tokens: List[str], theorems: List[Dict[str, Any]], key, embedding, version) -> str:
+    """Join the generated tokens, count them and cache the answer."""
+    answer = "".join(tokens)
+    completion_tokens.observe(count_tokens(answer), template= template_name)
+    if key:
+        answer_cache.put(key, (answer, theorems, embedding), version= version)
+    return answer
+
+
+def sse_event(event: str, data) -> str:
+    # data is JSON encoded so newlines in tokens don't break the SSE framing
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
@@ -0,0 +1,134 @@
+import os
+from typing import List, Dict, Any
+from dotenv import load_dotenv
+
+from graph import get_graph, async_query, get_graph_version, aget_graph_version
+from cache import VersionedLRUCache
+
+load_dotenv(".env")
+
+retrieval_depth = int(os.getenv("RETRIEVAL_DEPTH", "1"))
+retrieval_max_examples = int(os.getenv("RETRIEVAL_MAX_EXAMPLES", "2"))
+
+theorem_cache = VersionedLRUCache(
+    max_entries= int(os.getenv("THEOREM_CACHE_SIZE", "2048")),
+    ttl= float(os.getenv("THEOREM_CACHE_TTL", "3600"))
+)
+
+
+def theorem_subgraph_query(depth: int = retrieval_depth, include_examples: bool = True) -> str:
+    # Variable length bounds can't be parameters in Cypher, depth is formatted in as an int
+    depth = max(0, int(depth))
+    dependencies = f"""
+    OPTIONAL MATCH (t)-[:DEPENDS_ON*1..{depth}]->(dep:Theorem)
+    WITH t, collect(DISTINCT dep {{.name, .statement, .proof, .type}}) AS dependencies
+    """ if depth else """
+    WITH t, [] AS dependencies
+    """
+    examples = """
+    OPTIONAL MATCH (e:Example)-[:ILLUSTRATES]->(t)
+    WITH t, dependencies, collect(DISTINCT e {.name, .content, .difficulty})[..$max_examples] AS examples
+    """ if include_examples else """
+    WITH t, dependencies, [] AS examples
+    """
+    return f"""
+    UNWIND $names AS name
+    MATCH (t:Theorem {{name: name}})
+    {dependencies}
+    {examples}
+    RETURN t.name AS name,
+        t.statement AS statement,
+        t.proof AS proof,
+        t.type AS type,
+        dependencies,
+        examples
+    """
+
+
+def _clean_names(names: List[str]) -> List[str]:
+    return list(dict.fromkeys(name.strip() for name in names if name and name.strip()))
+
+
+def _in_request_order(names: List[str], records: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    position = {name: i for i, name in enumerate(names)}
+    return sorted(records, key=lambda record: position.get(record['name'], len(position)))
+
+
+def _cached(names: List[str], options: tuple):
+    # Splits names into cached records (None for "not in the graph") and the ones to fetch
+    cached, missing = {}, []
+    for name in names:
+        found, record = theorem_cache.lookup((name,) + options)
+        if found:
+            cached[name] = record
+        else:
+            missing.append(name)
+    return cached, missing
+
+
+def _store(names: List[str], records: List[Dict[str, Any]], options: tuple, version, cached: dict):
+    by_name = {record['name']: record for record in records}
+    for name in names:
+        theorem_cache.put((name,) + options, by_name.get(name), version= version)
+        cached[name] = by_name.get(name)
+
+
+def get_theorems_subgraph(names: List[str], depth: int = retrieval_depth, include_examples: bool = True,
+                          max_examples: int = retrieval_max_examples, use_cache: bool = True) -> List[Dict[str, Any]]:
+    """Fetch the named theorems with their dependencies and examples in one query.
+
+    Each record has name, statement, proof, type, dependencies (theorems up to
+    depth DEPENDS_ON hops away) and examples (up to max_examples that
+    ILLUSTRATE it). Names that aren't in the graph are left out.
+    Records come from theorem_cache when the graph version hasn't moved;
+    only the names it misses are queried.
+    """
+    names = _clean_names(names)
+    if not names:
+        return []
+    if not use_cache:
+        records = get_graph().query(
+            theorem_subgraph_query(depth, include_examples),
+            params={'names': names, 'max_examples': max_examples}
+        )
+        return _in_request_order(names, records)
+
+    if theorem_cache.version_due():
+        theorem_cache.set_version(get_graph_version())
+    version = theorem_cache.version
+    options = (depth, include_examples, max_examples)
+    cached, missing = _cached(names, options)
+    if missing:
+        records = get_graph().query(
+            theorem_subgraph_query(depth, include_examples),
+            params={'names': missing, 'max_examples': max_examples}
+        )
+        _store(missing, records, options, version, cached)
+    return [cached[name] for name in names if cached.get(name)]
+
+
+async def aget_theorems_subgraph(names: List[str], depth: int = retrieval_depth, include_examples: bool = True,
+                                 max_examples: int = retrieval_max_examples, use_cache: bool = True) -> List[Dict[str, Any]]:
+    """Async get_theorems_subgraph, through the async neo4j driver."""
+    names = _clean_names(names)
+    if not names:
+        return []
+    if not use_cache:
+        records = await async_query(
+            theorem_subgraph_query(depth, include_examples),
+            params={'names': names, 'max_examples': max_examples}
+        )
+        return _in_request_order(names, records)
+
+    if theorem_cache.version_due():
+        theorem_cache.set_version(await aget_graph_version())
+    version = theorem_cache.version
+    options = (depth, include_examples, max_examples)
+    cached, missing = _cached(names, options)
+    if missing:
+        records = await async_query(
+            theorem_subgraph_query(depth, include_examples),
+            params={'names': missing, 'max_examples': max_examples}
+        )
+        _store(missing, records, options, version, cached)
+    return [cached[name] for name in names if cached.get(name)]
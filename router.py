@@ -0,0 +1,285 @@
+import os
+import re
+import asyncio
+import time
+import threading
+from collections import deque
+from typing import Iterable, List, Optional
+from dotenv import load_dotenv
+
+from base_logger import logger
+from graph import get_graph, get_graph_version, async_query, aget_graph_version
+from name_index import THEOREM_NAMES_QUERY, TrigramNameResolver
+
+load_dotenv(".env")
+
+use_question_router = os.getenv("USE_QUESTION_ROUTER", "1") == "1"
+router_min_name_length = int(os.getenv("ROUTER_MIN_NAME_LENGTH", "5"))
+name_resolver_cutoff = float(os.getenv("NAME_RESOLVER_CUTOFF", "0.6"))
+graph_version_check_seconds = float(os.getenv("GRAPH_VERSION_CHECK_SECONDS", "5"))
+
+# What parse_question answers for questions that need no retrieval
+NO_ALGEBRA = "No algebra"
+
+SMALL_TALK = {
+    "hi", "hello", "hey", "yo", "thanks", "thank you", "thx", "ok", "okay", "bye", "goodbye",
+    "good morning", "good evening", "good night", "how are you", "who are you", "what are you",
+}
+SMALL_TALK_WORDS = {word for phrase in SMALL_TALK for word in phrase.split()} | {
+    "there", "so", "much", "a", "lot", "again", "bot", "great", "cool", "nice", "doing",
+}
+
+ALGEBRA_WORDS = {
+    "group", "subgroup", "ring", "field", "ideal", "module", "vector", "matrix", "matrices", "linear",
+    "polynomial", "eigenvalue", "eigenvector", "determinant", "rank", "kernel", "image", "basis",
+    "dimension", "homomorphism", "isomorphism", "automorphism", "coset", "quotient", "order", "prime",
+    "theorem", "lemma", "corollary", "proposition", "proof", "prove", "equation", "solve", "root",
+    "factor", "divisor", "integer", "algebra", "algebraic", "permutation", "cyclic", "abelian",
+    "span", "orthogonal", "invertible", "inverse", "commutative", "sylow", "galois", "extension",
+}
+
+# Words books use as theorem labels, names made only of these and numbering say nothing about the question
+TYPE_WORDS = {
+    "theorem", "lemma", "corollary", "proposition", "definition", "result", "claim", "remark", "fact",
+    "example", "exercise", "problem", "note", "notes", "step", "case", "part", "axiom", "conjecture",
+    "observation", "property", "main", "key", "first", "second", "third", "final",
+}
+LABEL = re.compile(r"^\(?([0-9]+(\.[0-9]+)*[a-z]?|[ivxlc]+|[a-z])\)?[.:]?$")
+
+# Questions that lean on an earlier turn ("why does it hold?", "prove that lemma", "what about the converse?");
+# "that" only with a noun after it, "prove that every group..." is a new question
+REFERS_BACK = re.compile(
+    r"\b(it|its|they|them|this|these|those|the same|same one|above|previous|previously|earlier|last one"
+    r"|before|again|the converse|what about|how about|and why|you said|you mentioned)\b"
+    r"|\bthat (" + "|".join(sorted(TYPE_WORDS | {"one", "proof", "statement", "definition"})) + r")s?\b|\bthat$"
+    r"|^(and|also|so|then|but|why)\b"
+)
+
+MATH_SYMBOLS = re.compile(r"[0-9=+\-*/^√∑∏∫≤≥≠∈∉⊂⊆∪∩→↦×·]")
+
+
+def normalize(text: str) -> str:
+    return re.sub(r"\s+", " ", text.lower()).strip()
+
+
+def _type_word(word: str) -> bool:
+    return word in TYPE_WORDS or (word.endswith("s") and word[:-1] in TYPE_WORDS)
+
+
+def refers_back(question: str) -> bool:
+    """Whether the question points back to earlier turns of the conversation."""
+    return bool(REFERS_BACK.search(normalize(question)))
+
+
+def is_distinctive_name(key: str) -> bool:
+    """Whether a normalized theorem name, found in a question, says which theorem it is about.
+
+    Labels ("Theorem", "Lemma 3", "Part 2", "(4)") are not, nor are one or
+    two word concepts ("Field", "Integral domain") which are more likely the
+    topic of the question than the result asked for. Named results are
+    ("Zorn's lemma", "Chinese Remainder Theorem"), and so are names that
+    state something ("Artinian integral domain is a field").
+    """
+    words = key.split()
+    if all(_type_word(word) or LABEL.match(word) for word in words):
+        return False
+    return any(_type_word(word) for word in words) or "'s" in key or len(words) >= 3
+
+
+class AhoCorasick:
+    """Aho-Corasick automaton: finds every pattern occurring in a text in one pass."""
+
+    def __init__(self, patterns: Iterable[str]):
+        self.goto = [{}]
+        self.fail = [0]
+        self.output = [[]]
+        for pattern in patterns:
+            self._add(pattern)
+        self._build()
+
+    def _add(self, pattern: str):
+        state = 0
+        for char in pattern:
+            if char not in self.goto[state]:
+                self.goto.append({})
+                self.fail.append(0)
+                self.output.append([])
+                self.goto[state][char] = len(self.goto) - 1
+            state = self.goto[state][char]
+        self.output[state].append(pattern)
+
+    def _build(self):
+        queue = deque(self.goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, next_state in self.goto[state].items():
+                queue.append(next_state)
+                fallback = self.fail[state]
+                while fallback and char not in self.goto[fallback]:
+                    fallback = self.fail[fallback]
+                self.fail[next_state] = self.goto[fallback].get(char, 0) if self.goto[fallback].get(char) != next_state else 0
+                self.output[next_state] = self.output[next_state] + self.output[self.fail[next_state]]
+
+    def search(self, text: str):
+        # Yields (start, end, pattern) for every occurrence
+        state = 0
+        for i, char in enumerate(text):
+            while state and char not in self.goto[state]:
+                state = self.fail[state]
+            state = self.goto[state].get(char, 0)
+            for pattern in self.output[state]:
+                yield i - len(pattern) + 1, i + 1, pattern
+
+
+class QuestionRouter:
+    """Answers the parse_question step locally when it can.
+
+    route() returns the theorem names found in the question (joined with ";"
+    like the LLM does), "No algebra" for small talk with nothing mathematical
+    in it, or None when unsure, in which case the LLM parser is used.
+    Only distinctive names are matched (not "Theorem", "Lemma 2", "Field"), and a
+    question that points back to an earlier turn ("this theorem") is left to
+    the LLM parser when there is chat history.
+    resolve_names() maps the names the LLM parser returns to graph names.
+    """
+
+    def __init__(self, names: Iterable[str] = (), version= None, min_name_length: int = router_min_name_length):
+        names = list(names)
+        self.version = version
+        self.resolver = TrigramNameResolver(names, cutoff= name_resolver_cutoff)
+        self.canonical = {}
+        self.generic = 0
+        for name in names:
+            key = normalize(name)
+            if len(key) < min_name_length:
+                continue
+            if not is_distinctive_name(key):
+                self.generic += 1
+                continue
+            self.canonical.setdefault(key, name)
+        self.matcher = AhoCorasick(self.canonical)
+
+    def find_theorems(self, question: str) -> List[str]:
+        text = normalize(question)
+        matches = []
+        for start, end, pattern in self.matcher.search(text):
+            # Whole words only, "ring" must not match inside "string"
+            if (start == 0 or not text[start - 1].isalnum()) and (end == len(text) or not text[end].isalnum()):
+                matches.append((start, end, pattern))
+        # Longest match wins when names overlap ("Sylow theorem" vs "Sylow theorems")
+        matches.sort(key=lambda match: (match[0], -(match[1] - match[0])))
+        names, covered_until = [], -1
+        for start, end, pattern in matches:
+            if start >= covered_until:
+                names.append(self.canonical[pattern])
+                covered_until = end
+        return list(dict.fromkeys(names))
+
+    def resolve_names(self, names: Iterable[str]) -> List[str]:
+        # Unresolved names are kept as they are, the exact match in retrieval may still find them
+        resolved = []
+        for name in names:
+            if not name or not name.strip():
+                continue
+            best = self.resolver.best(name)
+            if best and best != name.strip():
+                logger.info(f"Resolved theorem name '{name.strip()}' -> '{best}'")
+            resolved.append(best or name.strip())
+        return list(dict.fromkeys(resolved))
+
+    def is_small_talk(self, question: str) -> bool:
+        text = normalize(question).strip(" ?!.,")
+        if MATH_SYMBOLS.search(text):
+            return False
+        words = set(re.findall(r"[a-z]+", text))
+        # Prefix match so plurals and derived forms count ("homomorphisms", "factorization")
+        if any(word.startswith(stem) for word in words for stem in ALGEBRA_WORDS):
+            return False
+        return text in SMALL_TALK or (bool(words) and words <= SMALL_TALK_WORDS)
+
+    def route(self, question: str, chat_history: str = "") -> Optional[str]:
+        if self.is_small_talk(question):
+            return NO_ALGEBRA
+        if chat_history.strip() and refers_back(question):
+            return None
+        names = self.find_theorems(question)
+        if names:
+            return " ; ".join(names)
+        return None
+
+
+_router = None
+_router_lock = threading.Lock()
+_rebuild_lock = threading.Lock()
+_router_checked_at = 0.0
+
+
+def build_router(names: Iterable[str], version= None) -> QuestionRouter:
+    global _router
+    router = QuestionRouter(names, version)
+    with _router_lock:
+        _router = router
+    logger.info(f"Built question router over {len(router.canonical)} theorem names ({router.generic} generic ones left out)")
+    return router
+
+
+def current_router() -> Optional[QuestionRouter]:
+    return _router
+
+
+def _router_due() -> bool:
+    global _router_checked_at
+    if _router is not None and time.monotonic() - _router_checked_at < graph_version_check_seconds:
+        return False
+    _router_checked_at = time.monotonic()
+    return True
+
+
+def get_router() -> QuestionRouter:
+    """Return the router, rebuilt from the graph's theorem names when the graph version moved.
+
+    One rebuild runs at a time; meanwhile the previous router keeps serving
+    (only the very first one is waited for).
+    """
+    if _router_due():
+        version = get_graph_version()
+        if (_router is None or _router.version != version) and _rebuild_lock.acquire(blocking=_router is None):
+            try:
+                if _router is None or _router.version != version:
+                    build_router((record['name'] for record in get_graph().query(THEOREM_NAMES_QUERY)), version)
+            finally:
+                _rebuild_lock.release()
+    return _router
+
+
+async def aget_router() -> QuestionRouter:
+    # Same as get_router, with the build (hundreds of ms on big graphs) off the event loop
+    if _router_due():
+        version = await aget_graph_version()
+        if _router is None or _router.version != version:
+            acquired = _rebuild_lock.acquire(blocking=False)
+            while not acquired and _router is None:
+                await asyncio.sleep(0.05)
+                acquired = _rebuild_lock.acquire(blocking=False)
+            if acquired:
+                try:
+                    if _router is None or _router.version != version:
+                        names = [record['name'] for record in await async_query(THEOREM_NAMES_QUERY)]
+                        await asyncio.to_thread(build_router, names, version)
+                finally:
+                    _rebuild_lock.release()
+    return _router
+
+
+def resolve_theorem_names(router: QuestionRouter, query: str) -> List[str]:
+    names = query.split(';')
+    return router.resolve_names(names) if router is not None else names
+
+
+def route_question(router: QuestionRouter, question: str, chat_history: str = "") -> Optional[str]:
+    if router is None:
+        return None
+    query = router.route(question, chat_history)
+    if query is not None:
+        logger.info(f"Routed locally: {query}")
+    return query
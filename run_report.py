@@ -0,0 +1,195 @@
+"""JSONL report of an ingestion run, and the command that summarizes it.
+
+loader.py writes one record per line: run_start/run_end, one "chunk" record
+per LLM call (latency, output tokens, parse/validation failures), "write",
+"links" and "embed" records with rows and DB time, and one "file" record per
+PDF. Summarize a report with:
+
+    python run_report.py [.cache/reports/ingest-....jsonl] [--top 10]
+"""
+import os
+import sys
+import json
+import time
+import glob
+import argparse
+import threading
+from collections import Counter
+from typing import List, Dict, Any
+from dotenv import load_dotenv
+
+load_dotenv(".env")
+
+ingest_report_dir = os.getenv("INGEST_REPORT_DIR", ".cache/reports")
+
+
+class RunReport:
+    """Appends records to a JSONL file, from any thread.
+
+    Does nothing until open() is called, so extraction code can record
+    unconditionally.
+    """
+
+    def __init__(self):
+        self.path = None
+        self.run_id = None
+        self._file = None
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return self._file is not None
+
+    def open(self, path: str = None) -> str:
+        self.run_id = time.strftime("%Y%m%d-%H%M%S")
+        path = path or os.path.join(ingest_report_dir, f"ingest-{self.run_id}.jsonl")
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with self._lock:
+            self.path = path
+            self._file = open(path, "a", encoding="utf-8", buffering=1)
+        return path
+
+    def record(self, type: str, **fields):
+        if self._file is None:
+            return
+        line = json.dumps(dict(type=type, time=round(time.time(), 3), run_id=self.run_id, **fields), default=str)
+        with self._lock:
+            if self._file is not None:
+                self._file.write(line + "\n")
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+
+run_report = RunReport()
+
+
+def latest_report(directory: str = ingest_report_dir) -> str:
+    reports = sorted(glob.glob(os.path.join(directory, "ingest-*.jsonl")), key=os.path.getmtime)
+    return reports[-1] if reports else None
+
+
+def read_report(path: str) -> List[Dict[str, Any]]:
+    records = []
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    continue
+    return records
+
+
+def percentile(values: List[float], q: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def summarize(records: List[Dict[str, Any]], top: int = 10) -> Dict[str, Any]:
+    by_type = {}
+    for record in records:
+        by_type.setdefault(record["type"], []).append(record)
+    chunks = by_type.get("chunk", [])
+    calls = [chunk for chunk in chunks if not chunk.get("cached")]
+    latencies = [chunk["llm_seconds"] for chunk in calls]
+    llm_seconds = sum(latencies)
+    output_tokens = sum(chunk.get("output_tokens", 0) for chunk in calls)
+    times = [record["time"] for record in records]
+    wall_seconds = max(times) - min(times) if times else 0.0
+    chunk_ids = {(chunk.get("file"), chunk.get("chunk")) for chunk in chunks}
+
+    writes = {}
+    for write in by_type.get("write", []):
+        entry = writes.setdefault(write["kind"], {"rows": 0, "succeeded": 0, "failed": 0, "seconds": 0.0})
+        for field in entry:
+            entry[field] += write.get(field, 0)
+
+    validation_errors = Counter(error for chunk in chunks for error in chunk.get("errors", []))
+    return {
+        "report_files": len(by_type.get("file", [])),
+        "chunks": len(chunk_ids),
+        "wall_seconds": round(wall_seconds, 1),
+        "chunks_per_second": round(len(chunk_ids) / wall_seconds, 3) if wall_seconds else 0.0,
+        "llm_calls": len(calls),
+        "cached_calls": len(chunks) - len(calls),
+        "llm_seconds": round(llm_seconds, 1),
+        "llm_p50": round(percentile(latencies, 0.5), 2),
+        "llm_p95": round(percentile(latencies, 0.95), 2),
+        "output_tokens": output_tokens,
+        "output_tokens_per_llm_second": round(output_tokens / llm_seconds, 1) if llm_seconds else 0.0,
+        "db_write_seconds": round(sum(entry["seconds"] for entry in writes.values()), 1),
+        "link_seconds": round(sum(record.get("seconds", 0) for record in by_type.get("links", [])), 1),
+        "embed_seconds": round(sum(record.get("seconds", 0) for record in by_type.get("embed", [])), 1),
+        "writes": writes,
+        "unresolved_links": sum(record.get("unresolved", 0) for record in by_type.get("links", [])[-1:]),
+        "failures": dict(Counter(chunk["failure"] for chunk in chunks if chunk.get("failure"))),
+        "invalid_theorems": sum(chunk.get("invalid_theorems", 0) for chunk in chunks),
+        "invalid_examples": sum(chunk.get("invalid_examples", 0) for chunk in chunks),
+        "repair_calls": sum(chunk.get("repairs", 0) for chunk in chunks),
+        "repaired_chunks": sum(1 for chunk in chunks if chunk.get("repaired")),
+        "repair_seconds": round(sum(chunk.get("repair_seconds", 0) for chunk in chunks), 1),
+        "top_validation_errors": validation_errors.most_common(top),
+        "slowest_chunks": sorted(calls, key=lambda chunk: -chunk["llm_seconds"])[:top],
+        "failing_chunks": [chunk for chunk in chunks if chunk.get("failure") or chunk.get("invalid_theorems") or chunk.get("invalid_examples")][:top],
+    }
+
+
+def _chunk_line(chunk: Dict[str, Any]) -> str:
+    reason = chunk.get("failure") or (f"{chunk.get('invalid_theorems', 0)} invalid theorem(s), {chunk.get('invalid_examples', 0)} invalid example(s)"
+                                      if chunk.get("invalid_theorems") or chunk.get("invalid_examples") else "")
+    return (f"  {os.path.basename(chunk.get('file') or '?')} chunk {chunk.get('chunk')} [{chunk.get('template')}] "
+            f"{chunk.get('llm_seconds', 0):.2f}s {chunk.get('output_tokens', 0)} tok"
+            + (f"  {reason}" if reason else "")
+            + (f"  {chunk['errors'][0]}" if chunk.get("errors") else ""))
+
+
+def format_summary(summary: Dict[str, Any]) -> str:
+    lines = [
+        f"chunks: {summary['chunks']} in {summary['wall_seconds']}s ({summary['chunks_per_second']} chunks/s), {summary['report_files']} file(s)",
+        f"llm: {summary['llm_calls']} call(s), {summary['cached_calls']} cached, {summary['llm_seconds']}s total, "
+        f"p50 {summary['llm_p50']}s, p95 {summary['llm_p95']}s, {summary['output_tokens']} output tokens "
+        f"({summary['output_tokens_per_llm_second']} tok/s)",
+        f"neo4j: writes {summary['db_write_seconds']}s, links {summary['link_seconds']}s, embeddings {summary['embed_seconds']}s, "
+        f"{summary['unresolved_links']} link(s) unresolved",
+    ]
+    for kind, entry in summary["writes"].items():
+        lines.append(f"  {kind}: {entry['succeeded']} written, {entry['failed']} failed of {entry['rows']} in {entry['seconds']:.1f}s")
+    lines.append(f"failures: {summary['failures'] or 'none'}, {summary['invalid_theorems']} invalid theorem(s), {summary['invalid_examples']} invalid example(s)")
+    if summary["repair_calls"]:
+        lines.append(f"repairs: {summary['repair_calls']} call(s) in {summary['repair_seconds']}s, {summary['repaired_chunks']} chunk(s) repaired")
+    for error, count in summary["top_validation_errors"]:
+        lines.append(f"  {count}x {error}")
+    lines.append("slowest chunks:")
+    lines.extend(_chunk_line(chunk) for chunk in summary["slowest_chunks"])
+    lines.append("failing chunks:")
+    lines.extend(_chunk_line(chunk) for chunk in summary["failing_chunks"])
+    return "\n".join(lines)
+
+
+def main(argv= None):
+    parser = argparse.ArgumentParser(description="Summarize an ingestion run report")
+    parser.add_argument("report", nargs="?", help="JSONL report, the latest one in INGEST_REPORT_DIR by default")
+    parser.add_argument("--top", type=int, default=10, help="how many slowest/failing chunks and errors to list")
+    parser.add_argument("--json", action="store_true", help="print the summary as JSON")
+    args = parser.parse_args(argv)
+
+    path = args.report or latest_report()
+    if not path:
+        print(f"No report found in {ingest_report_dir}", file=sys.stderr)
+        return 1
+    summary = summarize(read_report(path), top=args.top)
+    print(json.dumps(summary, indent=2) if args.json else f"{path}\n{format_summary(summary)}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
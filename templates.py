@@ -70,6 +70,56 @@ Rules:
 Text to analyze:
 {text}
 
+JSON response:""",
+
+    "theorem_example": """You are an expert mathematician. Extract all mathematical theorems, lemmas, propositions, corollaries and all mathematical examples from the text below.
+
+Return ONLY a valid JSON object in this exact format (no other text):
+{{
+"theorems": [
+{{
+    "name": "theorem name",
+    "statement": "formal mathematical statement",
+    "proof": "proof text or 'Not provided'",
+    "subject": "main subject: Algebra, Analysis, Topology, Number Theory, Geometry, Probability, or Logic",
+    "domain": "specific subdomain like Linear Algebra, Real Analysis, Group Theory, etc.",
+    "dependencies": ["theorem1", "theorem2"],
+    "type":  "Theorem, Lemma, Proposition, Corollary, Conjecture, Definition, property or Hypothesis"
+}}
+],
+"examples": [
+{{
+    "name": "example title or 'Example: [brief description]'",
+    "content": "the complete example with solution/work shown",
+    "subject": "same subject classification as theorems",
+    "domain": "same domain classification as theorems",
+    "illustrates_theorems": ["theorem names that this example demonstrates"],
+    "difficulty": "Easy, Medium, or Hard"
+}}
+]
+}}
+
+Rules:
+1. Extract ALL mathematical statements and ALL mathematical examples
+2. Use clear, standard mathematical terminology
+3. If proof is not explicit, write "Not provided"
+4. Dependencies are theorem names mentioned in the proof
+5. Examples include worked problems, illustrations, applications.
+6. Examples should reference which theorems they demonstrate, use the same names as in "theorems" when they are in the text.
+7. Return valid JSON only
+8. Read the Context twice and carefully before generating JSON object.
+9. Do not return anything other than the JSON object.
+10. Do not include any explanations or apologies in your responses.
+11. Do not hallucinate.
+12. Skip any book introduction.
+13. chose one type for theorem type
+14. Preserve all mathematical symbols exactly. 
+15. If no theorems or no examples found, return an empty array for it.
+16. Do Not Use Invalid \escape in Json
+
+Text to analyze:
+{text}
+
 JSON response:""",
 
     "parse_question":"""
@@ -102,10 +152,7 @@ chat history: {chat_history}
 User Question: {question}
 
 Notes:
-1. Theorems are represented as:
-{{theorem_1: "other theorem it depends on",
-theorem_2: "other theorem it depends on",
-}}
+1. Each theorem is given as "name (type): statement", followed by its proof, the theorems it depends on ("Depends on") and examples illustrating it; long proofs are cut short with "…".
 
 Rules:
 1. Apply the given theorem to solve the question, provided it is relevant.
@@ -124,5 +171,39 @@ chat history:
 User Question: {question}
 
 Provide a clear,  precise answer. 
-"""
+""",
+
+    "summarize_history":"""
+You are summarizing a conversation between a user and a mathematical assistant specialized in algebra.
+
+Previous summary:
+{summary}
+
+New messages:
+{messages}
+
+Rules:
+1. Return only the updated summary, no explanations.
+2. Keep the theorems, definitions and notation the user asked about, and what was concluded.
+3. Keep it under {max_words} words.
+""",
+
+    "repair_json":"""You are an expert mathematician. The JSON you extracted from the text below failed validation.
+
+Errors:
+{errors}
+
+Your previous output:
+{response}
+
+Text it was extracted from:
+{text}
+
+Rules:
+1. Return ONLY the corrected JSON object, with the same top level keys ({keys}).
+2. Fix the errors using the text, every required field must be filled in and not empty.
+3. Drop items that can't be fixed from the text, keep the valid ones unchanged.
+4. Preserve all mathematical symbols exactly.
+
+JSON response:"""
 }
\ No newline at end of file
@@ -1,42 +1,158 @@
 import re
 import os
 import json
+import time
 import fitz
-from typing import List
+import threading
+from functools import lru_cache
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
+from typing import List, Dict, Iterable, Iterator
 from dotenv import load_dotenv
 
-from langchain_text_splitters import RecursiveCharacterTextSplitter
-from docling.document_converter import DocumentConverter
 
 from theorem import Theorem
 from example import Example
 from base_logger import logger
 from templates import templates
+from cache import extraction_cache
 
-from chains import create_llm_chain
-converter = DocumentConverter()
+from chains import get_llm_chain, invoke_with_usage
+from run_report import run_report
 
 load_dotenv(".env")
 
 ollama_base_url = os.getenv("OLLAMA_BASE_URL")
 llm_name = os.getenv("LLM")
+extraction_mode = os.getenv("EXTRACTION_MODE", "separate")
+# Constrain extraction output to the Theorem/Example JSON schema, retrying invalid output with a repair prompt
+structured_output = os.getenv("STRUCTURED_OUTPUT", "0") == "1"
+repair_attempts = int(os.getenv("EXTRACTION_REPAIR_ATTEMPTS", "1"))
+pdf_processes = int(os.getenv("PDF_PROCESSES", "1"))
+pdf_process_min_pages = int(os.getenv("PDF_PROCESS_MIN_PAGES", "200"))
+pdf_pages_per_task = int(os.getenv("PDF_PAGES_PER_TASK", "25"))
 
 
-def read_pdf(pdf_path: str, logger = logger) -> str:
-    text = ""
+_converter = None
+
+
+def get_converter():
+    # docling is slow to import and build, and only needed for layout-aware conversion
+    global _converter
+    if _converter is None:
+        from docling.document_converter import DocumentConverter
+        _converter = DocumentConverter()
+    return _converter
+
+
+def parse_concurrency_limits(value: str) -> Dict[str, int]:
+    # "4" sets the default, "http://host:11434=2" sets a limit for one endpoint.
+    # Entries are separated by commas: "2,http://gpu-box:11434=6"
+    limits = {}
+    for entry in (value or "").split(","):
+        entry = entry.strip()
+        if not entry:
+            continue
+        url, sep, limit = entry.rpartition("=")
+        try:
+            limits[url.strip().rstrip("/") if sep else "*"] = max(1, int(limit))
+        except ValueError:
+            logger.warning(f"Ignoring invalid OLLAMA_CONCURRENCY entry: {entry}")
+    return limits
+
+
+ollama_concurrency = parse_concurrency_limits(os.getenv("OLLAMA_CONCURRENCY", "1"))
+_endpoint_semaphores = {}
+_endpoint_semaphores_lock = threading.Lock()
+
+
+def get_concurrency_limit(base_url: str = ollama_base_url) -> int:
+    return ollama_concurrency.get((base_url or "").rstrip("/"), ollama_concurrency.get("*", 1))
+
+
+def endpoint_semaphore(base_url: str = ollama_base_url) -> threading.BoundedSemaphore:
+    # One semaphore per Ollama endpoint, shared by every extraction running in the process
+    key = (base_url or "").rstrip("/")
+    with _endpoint_semaphores_lock:
+        if key not in _endpoint_semaphores:
+            _endpoint_semaphores[key] = threading.BoundedSemaphore(get_concurrency_limit(key))
+        return _endpoint_semaphores[key]
+
+
+def _extract_pages(pdf_path: str, first: int, last: int) -> List[str]:
+    # Runs in a worker process, so it opens its own handle on the document
+    with fitz.open(pdf_path) as doc:
+        return [doc.load_page(page_num).get_text() for page_num in range(first, last)]
+
+
+def iter_pdf_pages(pdf_path: str, logger = logger, processes: int = pdf_processes, pages_per_task: int = pdf_pages_per_task) -> Iterator[str]:
+    """Yield the text of each page in order.
+
+    Books with at least PDF_PROCESS_MIN_PAGES pages are split in ranges of
+    pages_per_task pages and extracted by a pool of processes; only a few
+    ranges are in flight at once so memory stays bounded.
+    A page that can't be read (or a broken pool) raises, so a caller never
+    mistakes a partly read book for a whole one.
+    """
     try:
-        doc = fitz.open(pdf_path)
-        
-        for page_num in range(len(doc)):
-            page = doc.load_page(page_num)
-            text += page.get_text() + "\n\n"
+        with fitz.open(pdf_path) as doc:
+            page_count = len(doc)
+            if processes <= 1 or page_count < pdf_process_min_pages:
+                for page_num in range(page_count):
+                    yield doc.load_page(page_num).get_text()
+                return
 
-        doc.close()
-        logger.info(f"Extracted {len(text)} characters")
-        return text
+        with ProcessPoolExecutor(max_workers= processes) as executor:
+            ranges = iter(range(0, page_count, pages_per_task))
+            pending = deque()
+            for first in ranges:
+                pending.append(executor.submit(_extract_pages, pdf_path, first, min(first + pages_per_task, page_count)))
+                if len(pending) >= processes * 2:
+                    yield from pending.popleft().result()
+            while pending:
+                yield from pending.popleft().result()
     except Exception as e:
         logger.info(f"Error reading PDF with PyMuPDF: {e}")
+        raise
+
+
+def read_pdf(pdf_path: str, logger = logger) -> str:
+    try:
+        text = "".join(page + "\n\n" for page in iter_pdf_pages(pdf_path, logger= logger))
+    except Exception:
         return ""
+    logger.info(f"Extracted {len(text)} characters")
+    return text
+
+
+def iter_chunks(pages: Iterable[str], chunk_size: int = 2500, chunk_overlap: int = 250, buffer_chunks: int = 8) -> Iterator[str]:
+    """Split a stream of pages into chunks without holding the whole book.
+
+    Pages are buffered until they hold about buffer_chunks chunks, the buffer
+    is split, and every chunk but the last is yielded. The last one starts
+    the next buffer so chunks never stop at a page boundary.
+
+    Chunks are the same from run to run, but not the same as splitting the
+    whole text at once (the splitter's merges depend on where a buffer
+    starts), so extraction cache entries written by extract_from_text on a
+    whole book miss here.
+    """
+    text_splitter = create_math_aware_splitter(chunk_size= chunk_size, chunk_overlap= chunk_overlap)
+    buffer = []
+    buffer_len = 0
+    for page in pages:
+        buffer.append(page + "\n\n")
+        buffer_len += len(page) + 2
+        if buffer_len < buffer_chunks * chunk_size:
+            continue
+        chunks = text_splitter.split_text("".join(buffer))
+        if len(chunks) < 2:
+            continue
+        yield from chunks[:-1]
+        buffer = [chunks[-1]]
+        buffer_len = len(chunks[-1])
+    if buffer:
+        yield from text_splitter.split_text("".join(buffer))
 
 
 def initialize_smth(driver, logger= logger):
@@ -56,6 +172,7 @@ def initialize_smth(driver, logger= logger):
 
 
 def create_math_aware_splitter(chunk_size: int = 2500, chunk_overlap: int = 250):
+    from langchain_text_splitters import RecursiveCharacterTextSplitter
     # Prioritized separators - split at these first
     proof_markers = [
         "\n\n\n",           # Major section breaks
@@ -91,31 +208,70 @@ def create_math_aware_splitter(chunk_size: int = 2500, chunk_overlap: int = 250)
         is_separator_regex=False
     )
 
-def extract_from_text(extract, text: str, logger= logger) :
+def extract_from_text(extract, text: str, logger= logger, ollama_base_url: str = ollama_base_url, max_workers: int = None, progress= None, mode: str = extraction_mode, source: str = None, structured: bool = structured_output) :
+    started = time.perf_counter()
     text_splitter = create_math_aware_splitter()
     chunks = text_splitter.split_text(text)
     logger.info(f"Split text into {len(chunks)} chunks")
-    print (chunks[200])
-    
-    all_theorems = []
-    all_examples = []
+    run_report.record("split", file= source, chunks= len(chunks), chars= len(text), seconds= round(time.perf_counter() - started, 3))
 
-    for i, chunk in enumerate(chunks, 1):
-        logger.info(f"Processing chunk {i}/{len(chunks)}")
-        theorems, examples = extract_from_chunk(extract= extract,chunk= chunk, logger= logger)
-        all_theorems.extend(theorems)
-        all_examples.extend(examples)
-        logger.info(f"Extracted {len(theorems)} theorems and {len(examples)} examples from chunk {i}")
-    
-    
-    unique_theorems = {t.name: t for t in all_theorems}.values()
-    unique_examples = {e.name: e for e in all_examples}.values()
+    theorems, examples = extract_from_chunks(
+        extract= extract,
+        chunks= chunks,
+        logger= logger,
+        ollama_base_url= ollama_base_url,
+        max_workers= max_workers,
+        progress= progress,
+        mode= mode,
+        source= source,
+        structured= structured
+    )
+
+    unique_theorems = {t.name: t for t in theorems}.values()
+    unique_examples = {e.name: e for e in examples}.values()
 
     logger.info(f"Total unique theorems extracted: {len(unique_theorems)}")
     logger.info(f"Total unique examples extracted: {len(unique_examples)}")
     
     return list(unique_theorems), list(unique_examples)
 
+def extract_from_chunks(extract, chunks: List[str], logger= logger, ollama_base_url: str = ollama_base_url, max_workers: int = None, progress= None, start: int = 0, total: int = None, mode: str = extraction_mode, source: str = None,
+                        structured: bool = structured_output, failed_chunks: list = None):
+    """Run extract_from_chunk over chunks with at most max_workers requests in flight.
+
+    Results are returned in chunk order whatever order the requests finish in.
+    start/total only number the chunks in logs and the run report when this is
+    one window of a file (total is None while the file is still being streamed).
+    progress, if given, is called as progress(done, total, chunk_index) after each chunk.
+    failed_chunks, if given, gets the index of every chunk whose LLM call failed.
+    """
+    if max_workers is None:
+        max_workers = get_concurrency_limit(ollama_base_url)
+    results = [None] * len(chunks)
+    done = 0
+
+    with ThreadPoolExecutor(max_workers= max(1, max_workers), thread_name_prefix= "extract") as executor:
+        futures = {
+            executor.submit(extract_from_chunk, extract= extract, chunk= chunk, logger= logger, ollama_base_url= ollama_base_url, mode= mode,
+                            source= source, chunk_index= start + i + 1, structured= structured, failed_chunks= failed_chunks): i
+            for i, chunk in enumerate(chunks)
+        }
+        for future in as_completed(futures):
+            i = futures[future]
+            results[i] = future.result()
+            done += 1
+            theorems, examples = results[i]
+            logger.info(f"Extracted {len(theorems)} theorems and {len(examples)} examples from chunk {start + i + 1}" + (f"/{total}" if total else ""))
+            if progress:
+                progress(start + done, total, start + i + 1)
+
+    all_theorems = []
+    all_examples = []
+    for theorems, examples in results:
+        all_theorems.extend(theorems)
+        all_examples.extend(examples)
+    return all_theorems, all_examples
+
 def clean_json_output(llm_output):
     text = llm_output.strip()
     
@@ -132,57 +288,193 @@ def clean_json_output(llm_output):
     
     return text
 
-def extract_from_chunk(extract, chunk: str, logger= logger) :
+def extraction_templates(extract, mode: str = extraction_mode) -> Dict[str, set]:
+    # "combined" asks for theorems and examples in one completion, "separate" makes one call per kind
+    if mode == "combined" and {"theorem", "example"} <= set(extract):
+        return {"theorem_example": {"theorem", "example"}}
+    return {w_extract: {w_extract} for w_extract in extract}
+
+EXTRACTION_MODELS = {"theorem": ("theorems", Theorem), "example": ("examples", Example)}
+
+
+@lru_cache(maxsize=None)
+def _extraction_schema(kinds: tuple) -> str:
+    properties = {}
+    for kind in kinds:
+        key, model = EXTRACTION_MODELS[kind]
+        item = model.model_json_schema()
+        # Same rule as the not_empty validators, so decoding can't produce an empty name or statement
+        for field in item.get("required", []):
+            if item["properties"][field].get("type") == "string":
+                item["properties"][field]["minLength"] = 1
+        properties[key] = {"type": "array", "items": item}
+    return json.dumps({"type": "object", "properties": properties, "required": list(properties)}, sort_keys=True)
+
+
+def extraction_schema(kinds) -> dict:
+    """JSON schema of an extraction response holding the given kinds, for Ollama's format."""
+    return json.loads(_extraction_schema(tuple(sorted(kinds))))
+
+
+def _invoke_extraction(template_name: str, inputs: dict, ollama_base_url: str, schema: dict = None):
+    # Returns (response, seconds spent in the LLM call, not waiting for the endpoint, output tokens)
+    params = {"format": schema} if schema else {}
+    llm_chain = get_llm_chain(
+        llm_name= llm_name,
+        ollama_base_url= ollama_base_url,
+        template=templates[template_name],
+        **params
+    )
+    with endpoint_semaphore(ollama_base_url):
+        started = time.perf_counter()
+        response, output_tokens = invoke_with_usage(llm_chain, inputs)
+        return response, round(time.perf_counter() - started, 3), output_tokens
+
+
+def _needs_repair(stats: dict) -> bool:
+    return bool(stats.get("failure") or stats.get("invalid_theorems") or stats.get("invalid_examples"))
+
+
+def _repair_improves(before: dict, after: dict) -> bool:
+    if after.get("failure"):
+        return False
+    if before.get("failure"):
+        return True
+    valid = lambda stats: stats["theorems"] + stats["examples"]
+    invalid = lambda stats: stats["invalid_theorems"] + stats["invalid_examples"]
+    return valid(after) >= valid(before) and invalid(after) < invalid(before)
+
+
+def extract_from_chunk(extract, chunk: str, logger= logger, ollama_base_url: str = ollama_base_url, mode: str = extraction_mode, source: str = None, chunk_index: int = None,
+                       structured: bool = structured_output, max_repairs: int = repair_attempts, failed_chunks: list = None) :
+        """Theorems and examples of one chunk.
+
+        With structured, the response is constrained to the extraction JSON
+        schema and, if it still fails validation, up to max_repairs repair
+        calls (previous output + errors + chunk) are made for this chunk
+        only. The output that was kept is what gets cached, with the number of
+        repairs tried, and a cached response that was already repaired (or
+        failed to be) isn't repaired again.
+        """
         theorems, examples =  [], []
-        for w_extract in extract:
+        for template_name, kinds in extraction_templates(extract, mode).items():
+            # One run report record per chunk and template, source/chunk_index say where the chunk came from
+            stats = {"file": source, "chunk": chunk_index, "template": template_name, "chars": len(chunk),
+                     "cached": False, "structured": structured, "llm_seconds": 0.0, "output_tokens": 0, "failure": None}
+            schema = extraction_schema(kinds) if structured else None
+            variant = json.dumps(schema, sort_keys=True) if schema else ""
             try:
-                llm_chain = create_llm_chain(
-                    llm_name= llm_name,
-                    ollama_base_url= ollama_base_url,
-                    template=templates[w_extract]
-                )
-                response = llm_chain.invoke({"text": chunk})
-                temp_theorems, temp_examples =  parse_response(response= clean_json_output(response))
+                entry = extraction_cache.get_entry(chunk, templates[template_name], llm_name, variant)
+                response = entry["response"] if entry is not None else None
+                stats["cached"] = response is not None
+                fresh = response is None
+                # A cached response that repairs already failed to fix is used as it is, so a hit doesn't call the LLM again
+                allowed_repairs = 0 if entry is not None and entry["repairs"] else max_repairs
+                if response is None:
+                    response, stats["llm_seconds"], stats["output_tokens"] = _invoke_extraction(template_name, {"text": chunk}, ollama_base_url, schema)
+                # Constrained output is plain JSON, the string fixes in clean_json_output could only damage it
+                parsed = parse_response(response= response if structured else clean_json_output(response), kinds= kinds, stats= stats)
+
+                repairs = 0
+                while structured and _needs_repair(stats) and repairs < allowed_repairs:
+                    repairs += 1
+                    repaired, seconds, _ = _invoke_extraction("repair_json", {
+                        "errors": "\n".join(stats.get("errors") or [stats.get("failure") or "invalid output"]),
+                        # A runaway output would crowd the chunk out of the context, the start is enough to fix
+                        "response": response[:6000],
+                        "text": chunk,
+                        "keys": ", ".join(EXTRACTION_MODELS[kind][0] for kind in sorted(kinds))
+                    }, ollama_base_url, schema)
+                    stats["repair_seconds"] = round(stats.get("repair_seconds", 0.0) + seconds, 3)
+                    repair_stats = {}
+                    repaired_parsed = parse_response(response= repaired, kinds= kinds, stats= repair_stats)
+                    if _repair_improves(stats, repair_stats):
+                        logger.info(f"Repaired extraction output of chunk {chunk_index}")
+                        stats.update(repair_stats, failure= None, repaired= True)
+                        response, parsed, fresh = repaired, repaired_parsed, True
+                stats["repairs"] = repairs
+                # Also rewritten after repairs of a cached response, so they aren't tried again next run
+                if fresh or repairs:
+                    extraction_cache.put(chunk, templates[template_name], llm_name, response, variant, repairs= repairs)
+
+                temp_theorems, temp_examples = parsed
                 theorems.extend(temp_theorems)
                 examples.extend(temp_examples)
             except Exception as e:
                 logger.error(f"Error extracting from chunk: {e}")
+                stats["failure"] = stats["failure"] or "llm_error"
+                stats.setdefault("errors", []).append(f"{type(e).__name__}: {str(e)[:200]}")
+                if failed_chunks is not None and stats["failure"] == "llm_error":
+                    failed_chunks.append(chunk_index)
+            run_report.record("chunk", **stats)
         return theorems, examples
 
 
-def parse_response(response:str):
+def validation_reason(e: Exception) -> str:
+    # pydantic errors as "field: message", the full repr is several lines per field
+    if hasattr(e, "errors"):
+        try:
+            return "; ".join(f"{'.'.join(str(part) for part in error['loc'])}: {error['msg']}" for error in e.errors()[:3])
+        except Exception:
+            pass
+    return f"{type(e).__name__}: {str(e)[:200]}"
+
+
+def parse_response(response:str, kinds= ("theorem", "example"), stats: dict = None):
+    """Validate the theorems and examples in an LLM JSON response.
+
+    Only the kinds asked for are returned, so a model that volunteers
+    examples in a theorem-only call doesn't leak them into the run.
+    stats, if given, gets the failure reason (no_json, json_error, error),
+    the counts of valid/invalid rows and the first validation errors.
+    """
+    stats = {} if stats is None else stats
+    stats.update(theorems= 0, examples= 0, invalid_theorems= 0, invalid_examples= 0)
+    errors = stats.setdefault("errors", [])
     try:
         json_match = re.search(r'\{.*\}', response, re.DOTALL)
         if not json_match:
             logger.warning("No JSON found in response")
+            stats["failure"] = "no_json"
             return [], []
         
         data = json.loads(json_match.group())
         logger.info(f"there is {len(data)} entire")
         theorems = []
-        for thm_data in data.get('theorems', []):
+        for thm_data in (data.get('theorems', []) if "theorem" in kinds else []):
             try:
                 theorem = Theorem(**thm_data)
                 theorems.append(theorem)
             except Exception as e:
                 logger.warning(f"Failed to validate theorem: {e}")
+                stats["invalid_theorems"] += 1
+                if len(errors) < 3:
+                    errors.append(f"theorem: {validation_reason(e)}")
                 continue
 
         examples = []
-        for ex_data in data.get('examples', []):
+        for ex_data in (data.get('examples', []) if "example" in kinds else []):
             try:
                 example = Example(**ex_data)
                 examples.append(example)
             except Exception as e:
                 logger.warning(f"Failed to validate example: {e}")
+                stats["invalid_examples"] += 1
+                if len(errors) < 3:
+                    errors.append(f"example: {validation_reason(e)}")
             continue
         
+        stats.update(theorems= len(theorems), examples= len(examples))
         return theorems, examples
     
     except json.JSONDecodeError as e:
         logger.error(f"JSON parsing error: {e}")
         #logger.info(response)
+        stats["failure"] = "json_error"
+        errors.append(f"json: {e.msg} at line {e.lineno} col {e.colno}")
         return [], []
     except Exception as e:
         logger.error(f"Error parsing response: {e}")
+        stats["failure"] = "error"
+        errors.append(f"{type(e).__name__}: {str(e)[:200]}")
         return [], []
\ No newline at end of file